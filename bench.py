@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the sequence generation, the requests db, the replies
+encoding and the metrics.
+
+Each benchmark is run --repeat times, and its time per call is reported in
+seconds with its min, median and standard deviation. The results can be saved
+as JSON with --output, and compared against a baseline with --baseline: the
+run fails when the median time of a benchmark is more than --threshold (30%
+by default) slower than the one of the baseline, or when a benchmark is
+missing from the baseline, which must then be regenerated. The median is
+compared rather than the min, which a single lucky measure would lower, and
+a regression is measured again up to --retries times before being reported,
+since another process may have slowed the benchmark down meanwhile.
+
+Use as following:
+    python3 bench.py --output bench_baseline.json
+    python3 bench.py --baseline bench_baseline.json --threshold 0.3
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import timeit
+
+from tornado.escape import json_encode
+
+from lib.db import (MemoryRequestsDB, RequestsDB, ShardedRequestsDB)
+from lib.fizzbuzz import FizzBuzzSeqGenerator
+from lib.cache import SequenceCache
+from server import (SequenceResponse, ServerMetrics, build_response)
+
+# limits of the generated sequences
+LIMITS = [100, 10000, 1000000]
+# (int1, int2) of the generated sequences: the classic one, divisors with a
+# common factor and a long period.
+DIVISORS = [(3, 5), (6, 10), (97, 89)]
+# divisors of the generated sequences with more than two rules
+RULES_DIVISORS = [(3, 5, 7), (2, 3, 5, 7, 11)]
+# number of rows of the requests table
+TABLE_SIZES = [1000, 100000]
+# number of shards of the sharded db
+DB_SHARDS = 4
+# size of the batches of requests added to the db
+BATCH_SIZE = 100
+# limits of the encoded replies
+REPLY_LIMITS = [1000, 99999]
+
+# {{{ Benchmarks
+
+def bench_sequences():
+    for limit in LIMITS:
+        for (int1, int2) in DIVISORS:
+            seqGenerator = FizzBuzzSeqGenerator(int1, int2, limit, "fizz", "buzz")
+            yield (f"sequence[{int1}_{int2}_{limit}]", seqGenerator.sequence)
+        for divisors in RULES_DIVISORS:
+            seqGenerator = FizzBuzzSeqGenerator(
+                limit=limit, rules=[(divisor, f"w{divisor}") for divisor in divisors])
+            yield (f"sequence[r_{'_'.join(map(str, divisors))}_{limit}]", seqGenerator.sequence)
+
+def bench_db(directory):
+    # the single SQLite db keeps the names of the benchmarks made before the
+    # other backends
+    for (backend, new_db) in [
+            ("", lambda path: RequestsDB(path, "none")),
+            (".memory", lambda path: MemoryRequestsDB("none")),
+            (".sharded", lambda path: ShardedRequestsDB(path, "none", nb_shards=DB_SHARDS))]:
+        for size in TABLE_SIZES:
+            db = new_db(os.path.join(directory, f"bench{backend}-{size}.db"))
+            db.add_batch((f"3_5_{limit}_fizz_buzz", None, limit % 100)
+                         for limit in range(2, size + 2))
+            # the batch updates existing rows, so that the table size doesn't change
+            batch = [(f"3_5_{limit}_fizz_buzz", None) for limit in range(2, BATCH_SIZE + 2)]
+            yield (f"db{backend}.add_batch[{size}]",
+                   lambda db=db, batch=batch: db.add_batch(batch))
+            yield (f"db{backend}.get[{size}]",
+                   lambda db=db, size=size: db.get(f"3_5_{size // 2}_fizz_buzz"))
+            yield (f"db{backend}.get_most_hit[{size}]", lambda db=db: db.get_most_hit(10))
+
+def bench_replies():
+    # the longest reply, from which the shorter ones are sliced
+    source = build_response(FizzBuzzSeqGenerator(3, 5, max(REPLY_LIMITS), "fizz", "buzz"), 1024)
+    for limit in REPLY_LIMITS:
+        seq = FizzBuzzSeqGenerator(3, 5, limit, "fizz", "buzz").sequence()
+        yield (f"reply.json_encode[{limit}]", lambda seq=seq: json_encode({"sequence": seq}))
+        yield (f"reply.response[{limit}]", lambda seq=seq: SequenceResponse(seq))
+        seqGenerator = FizzBuzzSeqGenerator(3, 5, limit, "fizz", "buzz")
+        yield (f"reply.build_response[{limit}]",
+               lambda seqGenerator=seqGenerator: build_response(seqGenerator, 1024))
+        yield (f"reply.prefix[{limit}]", lambda limit=limit: source.prefix(limit, 1024))
+
+def bench_metrics():
+    metrics = ServerMetrics(SequenceCache())
+    # the recording done for each request
+    def observe():
+        metrics.request_duration.labels("FizzBuzzSequenceHandler").observe(0.002)
+        metrics.response_size.labels("FizzBuzzSequenceHandler").observe(1500)
+    yield ("metrics.observe", observe)
+    yield ("metrics.render", metrics.render)
+
+# }}}
+
+def measure(func, repeat):
+    """
+    Return the min, median and standard deviation of the time of a call to
+    func, measured repeat times.
+    """
+    timer = timeit.Timer(func)
+    (number, _) = timer.autorange()
+    times = [time / number for time in timer.repeat(repeat, number)]
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+def compare(results, baseline, threshold):
+    """
+    Return the names of the benchmarks whose median time regressed by more
+    than threshold against the baseline, and the names of the ones missing
+    from the baseline.
+    """
+    regressions = []
+    missing = []
+    for (name, res) in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            missing.append(name)
+        elif res["median"] > ref["median"] * (1 + threshold):
+            regressions.append(name)
+    return (regressions, missing)
+
+def main():
+    parser = argparse.ArgumentParser(description="fizzbuzz microbenchmarks")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of measures of each benchmark")
+    parser.add_argument("--filter", default="",
+                        help="only run the benchmarks whose name contains this string")
+    parser.add_argument("--output", help="save the results as JSON in this file")
+    parser.add_argument("--baseline", help="compare the results with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.3,
+                        help="accepted slow down of the median time against the baseline")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="number of measures of a regression before it's reported")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    def report(name, res):
+        ref = baseline.get(name)
+        ratio = f"{res['median'] / ref['median']:6.2f}x" if ref else ""
+        print(f"{name:32} min {res['min'] * 1e6:12.1f}us "
+              f"median {res['median'] * 1e6:12.1f}us "
+              f"stddev {res['stddev'] * 1e6:10.1f}us {ratio}")
+
+    results = {}
+    funcs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for benchmarks in [bench_sequences(), bench_db(directory), bench_replies(),
+                           bench_metrics()]:
+            for (name, func) in benchmarks:
+                if args.filter not in name:
+                    continue
+                funcs[name] = func
+                results[name] = measure(func, args.repeat)
+                report(name, results[name])
+
+        (regressions, missing) = compare(results, baseline, args.threshold)
+        # a benchmark slowed down by another process meanwhile is measured
+        # again, only the ones still slower each time are regressions
+        for _ in range(args.retries):
+            for name in regressions:
+                res = measure(funcs[name], args.repeat)
+                print("again: ", end="")
+                report(name, res)
+                if res["median"] < results[name]["median"]:
+                    results[name] = res
+            (regressions, missing) = compare(results, baseline, args.threshold)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    if missing:
+        print(f"missing from the baseline: {', '.join(missing)}")
+    if regressions:
+        print(f"regressions of more than {args.threshold:.0%}: {', '.join(regressions)}")
+    return 1 if regressions or missing else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,2 +1,10 @@
+from . import admission
+from . import cache
 from . import db
 from . import fizzbuzz
+from . import metrics
+from . import profiler
+from . import requests_queue
+from . import singleflight
+from . import topk
+from . import writer
@@ -0,0 +1,115 @@
+import asyncio
+from collections import deque
+
+__all__ = (
+    "AdmissionControl",
+    "AdmissionError",
+)
+
+class AdmissionError(RuntimeError):
+    """
+    Raised when a heavy computation is rejected, the heavy lane being full.
+    """
+
+class AdmissionControl:
+    """
+    Admission of the computations by their estimated cost. The cheap ones go
+    to the fast lane, which is never limited. At most max_heavy heavy ones,
+    whose cost is at least heavy_min_cost, run at the same time, and at most
+    max_waiting wait for their turn, in order: beyond that they are rejected
+    with an AdmissionError, so that the heavy requests cannot hold back the
+    cheap ones.
+
+    Use as following:
+        admission = AdmissionControl(heavy_min_cost=100000)
+        async with admission.admit(cost) as heavy:
+            await run_in_executor(heavy_executor if heavy else fast_executor, ...)
+    """
+
+    def __init__(self, heavy_min_cost=100000, max_heavy=2, max_waiting=16):
+        self.heavy_min_cost = int(heavy_min_cost)
+        self.max_heavy = int(max_heavy)
+        self.max_waiting = int(max_waiting)
+        # number of heavy computations running
+        self.nb_running = 0
+        # futures of the heavy computations waiting for their turn
+        self.waiters = deque()
+        self.nb_fast = 0
+        self.nb_heavy = 0
+        self.nb_rejected = 0
+
+    def is_heavy(self, cost):
+        return cost >= self.heavy_min_cost
+
+    def admit(self, cost, reject=True):
+        """
+        Return the asynchronous context manager waiting for the computation
+        of the given cost to be admitted, which gives whether it's heavy.
+        Entering it raises AdmissionError if it's rejected, unless reject is
+        False: the computation then waits for its turn however many wait,
+        e.g. the next part of a reply already started.
+        """
+        return _Admission(self, cost, reject)
+
+    async def _acquire(self, reject=True):
+        if self.nb_running < self.max_heavy:
+            self.nb_running += 1
+            return
+        if reject and len(self.waiters) >= self.max_waiting:
+            self.nb_rejected += 1
+            raise AdmissionError(f"too many heavy requests, {self.nb_running} running "
+                                 f"and {len(self.waiters)} waiting")
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append(future)
+        try:
+            # the slot of the releasing computation is handed over
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            elif future in self.waiters:
+                self.waiters.remove(future)
+            raise
+
+    def _release(self):
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.nb_running -= 1
+
+    def stats(self):
+        return {
+            "running": self.nb_running,
+            "waiting": len(self.waiters),
+            "fast": self.nb_fast,
+            "heavy": self.nb_heavy,
+            "rejected": self.nb_rejected,
+        }
+
+class _Admission:
+    """
+    Admission of a computation, entered with "async with".
+    """
+
+    def __init__(self, control, cost, reject=True):
+        self.control = control
+        self.cost = cost
+        self.reject = reject
+        self.heavy = False
+
+    async def __aenter__(self):
+        if not self.control.is_heavy(self.cost):
+            self.control.nb_fast += 1
+            return False
+        await self.control._acquire(self.reject)
+        self.heavy = True
+        self.control.nb_heavy += 1
+        return True
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if self.heavy:
+            self.heavy = False
+            self.control._release()
+        return False
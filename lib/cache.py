@@ -0,0 +1,175 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import sys
+
+__all__ = (
+    "PrefixIndex",
+    "SequenceCache",
+)
+
+class SequenceCache:
+    """
+    LRU cache of the fizzbuzz sequences, bounded by the memory used by its
+    entries rather than by their number since a sequence can take from a few
+    bytes to several megabytes.
+
+    The size of an entry is the memory used by its key and its value, unless the
+    value size is given to put. The least recently used entries are evicted as
+    long as the total size is over max_bytes, and a value which alone is bigger
+    than max_bytes is not cached.
+    """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = int(max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size), ordered from the least to the most recently used
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=None):
+        size = sys.getsizeof(key) + (size if size is not None else sys.getsizeof(value))
+        if size > self.max_bytes:
+            return False
+        self.remove(key)
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            (_, (_, evicted_size)) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+        return True
+
+    def keys(self):
+        """
+        Return the keys, from the least to the most recently used.
+        """
+        return list(self._entries)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        """
+        Remove all the entries, the counters are kept.
+        """
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class PrefixIndex:
+    """
+    Index of the keys of a SequenceCache by family, a sequence of a family
+    being the prefix of the longer ones. It finds the shortest cached sequence
+    of a family at least as long as a given length, from which a shorter one
+    can be sliced rather than computed.
+
+    The keys evicted from the cache are dropped from the index when they are
+    met, or all at once when the index holds twice as many keys as the cache,
+    so the index never keeps a value alive.
+
+    Use as following:
+        index = PrefixIndex(cache)
+        cache.put("3_5_1000_fizz_buzz", seq)
+        index.add((3, 5, "fizz", "buzz"), 1000, "3_5_1000_fizz_buzz")
+        (length, seq) = index.find((3, 5, "fizz", "buzz"), 100)
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        # family -> sorted (length, key) of its cached sequences
+        self.families = {}
+        self.nb_entries = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.nb_entries
+
+    def add(self, family, length, key):
+        entries = self.families.setdefault(family, [])
+        pos = bisect_left(entries, (length, key))
+        if pos < len(entries) and entries[pos] == (length, key):
+            return
+        entries.insert(pos, (length, key))
+        self.nb_entries += 1
+        if self.nb_entries > 2 * len(self.cache) + 16:
+            self._prune()
+
+    def remove(self, family, length, key):
+        """
+        Remove a key from the index, e.g. when its cached value is replaced by
+        one which can't be a prefix source.
+        """
+        entries = self.families.get(family)
+        if not entries:
+            return
+        pos = bisect_left(entries, (length, key))
+        if pos < len(entries) and entries[pos] == (length, key):
+            del entries[pos]
+            self.nb_entries -= 1
+            if not entries:
+                del self.families[family]
+
+    def _prune(self):
+        for (family, entries) in list(self.families.items()):
+            entries[:] = [entry for entry in entries if entry[1] in self.cache]
+            if not entries:
+                del self.families[family]
+        self.nb_entries = sum(len(entries) for entries in self.families.values())
+
+    def find(self, family, length):
+        """
+        Return the (length, value) of the shortest cached sequence of family
+        at least as long as length, None if there is none.
+        """
+        entries = self.families.get(family)
+        if entries:
+            pos = bisect_left(entries, (length, ""))
+            while pos < len(entries):
+                (found_length, key) = entries[pos]
+                value = self.cache.get(key) if key in self.cache else None
+                if value is not None:
+                    self.hits += 1
+                    return (found_length, value)
+                del entries[pos]
+                self.nb_entries -= 1
+            if not entries:
+                del self.families[family]
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return {
+            "families": len(self.families),
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
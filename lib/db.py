@@ -1,10 +1,130 @@
+from abc import (ABC, abstractmethod)
+import heapq
+from itertools import islice
+import os
 import sqlite3
+import threading
+import zlib
 
 __all__ = (
+    "MemoryRequestsDB",
+    "PartialBatchError",
     "RequestsDB",
+    "RequestsStore",
+    "ShardedRequestsDB",
 )
 
-class RequestsDB:
+SEQUENCE_MODES = ("full", "compressed", "none")
+
+class PartialBatchError(RuntimeError):
+    """
+    Raised by the stores whose batches are not atomic when a part of a batch
+    fails to be saved, the other parts being saved: recs are the records
+    which are not saved, which can be added again without counting the saved
+    ones twice.
+    """
+
+    def __init__(self, msg, recs):
+        super().__init__(msg)
+        self.recs = recs
+
+class RequestsStore(ABC):
+    """
+    Interface of the stores of the fizzbuzz requests, used by the server and
+    the writer: add_batch saves a batch of requests, get returns the sequence
+    of a request, get_most_hit and get_counts the most hit requests, and clear
+    removes all of them. The stores implement them all, RequestsStore
+    can't be instantiated.
+
+    A request is saved by id, along with its sequence according to
+    sequence_mode and the number of times it was made. The records of a batch
+    are merged by id by _merge, so that each id is written once.
+
+    Use as following:
+        db = MemoryRequestsDB()
+        db.add_batch([("3_5_20_fizz_buzz", None), ("3_5_20_fizz_buzz", None, 2)])
+        db.get_most_hit(10)
+    """
+
+    def __init__(self, sequence_mode="full", compress_min_len=4096):
+        if sequence_mode not in SEQUENCE_MODES:
+            raise ValueError(f"unknown sequence mode {sequence_mode}, "
+                             f"expected one of {SEQUENCE_MODES}")
+        self.sequence_mode = sequence_mode
+        self.compress_min_len = int(compress_min_len)
+
+    def _encode(self, seq):
+        if seq is None or self.sequence_mode == "none":
+            return None
+        if self.sequence_mode == "compressed" and len(seq) >= self.compress_min_len:
+            # the fastest level, sequences compress well anyway
+            return zlib.compress(seq.encode(), 1)
+        return seq
+
+    @staticmethod
+    def _decode(seq):
+        if isinstance(seq, bytes):
+            return zlib.decompress(seq).decode()
+        return seq
+
+    @staticmethod
+    def _merge(recs):
+        """
+        Return the {reqId: [seq, occurrence]} of a batch of records, see
+        add_batch.
+        """
+        batch = {}
+        for rec in recs:
+            (reqId, seq) = rec[:2]
+            occurrence = rec[2] if len(rec) > 2 else 1
+            entry = batch.get(reqId)
+            if entry is None:
+                batch[reqId] = [seq, occurrence]
+            else:
+                entry[0] = entry[0] if entry[0] is not None else seq
+                entry[1] += occurrence
+        return batch
+
+    def add(self, reqId, seq, commit=True):
+        self.add_batch([(reqId, seq)], commit)
+
+    @abstractmethod
+    def add_batch(self, recs, commit=True):
+        """
+        Add a batch of (reqId, seq) records, seq being None for the requests whose
+        sequence is not saved. A record can also be (reqId, seq, occurrence) to count
+        several requests at once.
+        """
+
+    @abstractmethod
+    def get(self, reqId):
+        """
+        Return the (sequence,) of a request, None if it's not saved.
+        """
+
+    @abstractmethod
+    def get_most_hit(self, max_rows=10):
+        """
+        Return the (id, sequence, occurrence) of the max_rows most hit requests.
+        """
+
+    @abstractmethod
+    def get_counts(self, max_rows=None):
+        """
+        Return the (id, occurrence) of the requests, from the most to the least
+        hit, without their sequences.
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Remove all the requests.
+        """
+
+    def close(self):
+        pass
+
+class RequestsDB(RequestsStore):
     """
     DB object allowing to track the fizzbuzz requests in order
     to build a statistics page.
@@ -15,12 +135,36 @@ class RequestsDB:
     Only valid requests are saved. A given request is represented by its parameters in the
     following order: "int1_int2_limit_str1_str2". The corresponding fizzbuzz sequense is
     saved along with the number of time the request was made.
+
+    As the sequence can be generated back from the request id, sequence_mode allows
+    to choose how it's saved: "full" saves it as text, "compressed" saves it as a zlib
+    compressed blob when it's at least compress_min_len characters long, and "none"
+    doesn't save it. get and get_most_hit return a None sequence when it's not saved.
+
+    The db uses the WAL journal so that get_most_hit, which uses its own connection,
+    never blocks the writes.
     """
 
-    def __init__(self, database=".requests.db"):
+    # version of the db layout, saved in the user_version pragma
+    SCHEMA_VERSION = 1
+
+    def __init__(self, database=".requests.db", sequence_mode="full", compress_min_len=4096):
+        super().__init__(sequence_mode, compress_min_len)
         self.database = database
         self.connection = sqlite3.connect(database, check_same_thread=False)
+        self._init_pragmas()
         self._init_table()
+        self._migrate()
+
+    def _init_pragmas(self):
+        cur = self.connection.cursor()
+        # readers don't block the writer, nor the writer the readers
+        cur.execute("PRAGMA journal_mode = WAL")
+        # with the WAL journal, the db stays consistent if only the WAL
+        # is synced on checkpoints
+        cur.execute("PRAGMA synchronous = NORMAL")
+        # 16MiB of pages cache
+        cur.execute("PRAGMA cache_size = -16384")
 
     def _init_table(self):
         sql1 = """
@@ -39,50 +183,100 @@ class RequestsDB:
         cur.execute(sql2)
         self.connection.commit()
 
-    def add(self, reqId, seq, commit=True):
-        sql1 = f"""
-            INSERT OR IGNORE INTO requests (id, sequence)
-            VALUES ("{reqId}", "{seq}")
+    def _migrate(self):
         """
-        sql2 = f"""
-            UPDATE requests
-            SET occurrence = occurrence + 1
-            WHERE id = "{reqId}"
+        Dbs created before the sequence modes hold full text sequences, rewrite
+        them according to the sequence mode.
         """
         cur = self.connection.cursor()
-        cur.execute(sql1)
-        cur.execute(sql2)
-        if commit:
-            self.connection.commit()
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        self.rewrite_sequences()
+        cur.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.connection.commit()
+
+    def rewrite_sequences(self):
+        """
+        Rewrite all the saved sequences according to the sequence mode, and give
+        back the freed space to the file system.
+        """
+        cur = self.connection.cursor()
+        if self.sequence_mode == "none":
+            cur.execute("UPDATE requests SET sequence = NULL WHERE sequence IS NOT NULL")
+        else:
+            ids = cur.execute(
+                "SELECT id FROM requests WHERE sequence IS NOT NULL").fetchall()
+            for (reqId,) in ids:
+                seq = cur.execute(
+                    "SELECT sequence FROM requests WHERE id = ?", (reqId,)).fetchone()[0]
+                cur.execute("UPDATE requests SET sequence = ? WHERE id = ?",
+                            (self._encode(self._decode(seq)), reqId))
+        self.connection.commit()
+        cur.execute("VACUUM")
 
     def add_batch(self, recs, commit=True):
-        for rec in recs:
-            self.add(rec[0], rec[1], False)
-        if commit:
-            self.connection.commit()
+        """
+        Add a batch of (reqId, seq) records, seq being None for the requests whose
+        sequence is not saved. A record can also be (reqId, seq, occurrence) to count
+        several requests at once. The records are merged by id so that each id is
+        written once.
+        """
+        batch = self._merge(recs)
+        sql = """
+            INSERT INTO requests (id, sequence, occurrence)
+            VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                sequence = coalesce(sequence, excluded.sequence),
+                occurrence = occurrence + excluded.occurrence
+        """
+        cur = self.connection.cursor()
+        try:
+            cur.executemany(sql, ((reqId, self._encode(seq), occurrence)
+                                  for (reqId, (seq, occurrence)) in batch.items()))
+            if commit:
+                self.connection.commit()
+        except sqlite3.Error:
+            # a batch is counted entirely or not at all, so that it can be
+            # added again without counting some requests twice.
+            self.connection.rollback()
+            raise
 
     def get(self, reqId):
-        sql = f"""
+        sql = """
             SELECT sequence from requests
-            WHERE id = "{reqId}"
+            WHERE id = ?
         """
         cur = self.connection.cursor()
-        cur.execute(sql)
-        return cur.fetchone()
+        cur.execute(sql, (reqId,))
+        res = cur.fetchone()
+        return (self._decode(res[0]),) if res is not None else None
 
     def get_most_hit(self, max_rows=10):
-        sql = f"""
+        sql = """
             SELECT id, sequence, occurrence FROM requests
             ORDER BY occurrence DESC
-            LIMIT {max_rows}
+            LIMIT ?
         """
+        # with the WAL journal, this reader doesn't block the writer connection
         conn = sqlite3.connect(self.database, check_same_thread=False)
         cur = conn.cursor()
-        cur.execute(sql)
-        res = cur.fetchall()
+        cur.execute(sql, (max_rows,))
+        res = [(reqId, self._decode(seq), occurrence)
+               for (reqId, seq, occurrence) in cur.fetchall()]
         conn.close()
         return res
 
+    def get_counts(self, max_rows=None):
+        sql = """
+            SELECT id, occurrence FROM requests
+            ORDER BY occurrence DESC
+            LIMIT ?
+        """
+        cur = self.connection.cursor()
+        cur.execute(sql, (max_rows if max_rows is not None else -1,))
+        return cur.fetchall()
+
     def clear(self):
         """
         Remove all rows in the db
@@ -92,6 +286,135 @@ class RequestsDB:
         cur.execute(sql)
         self.connection.commit()
 
+    def close(self):
+        self.connection.close()
+
     def get_db_connection(self):
         return self.connection
 
+class MemoryRequestsDB(RequestsStore):
+    """
+    Requests store held in memory, for the tests and the benchmarks, or for a
+    server whose statistics don't need to survive a restart. It can be shared
+    by the server and the writer threads. Having no index, get_most_hit goes
+    through all the requests.
+
+    Use as following:
+        db = MemoryRequestsDB(sequence_mode="none")
+        db.add_batch(recs)
+    """
+
+    def __init__(self, sequence_mode="full", compress_min_len=4096):
+        super().__init__(sequence_mode, compress_min_len)
+        # reqId -> [encoded sequence, occurrence], in insertion order
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add_batch(self, recs, commit=True):
+        batch = self._merge(recs)
+        with self._lock:
+            for (reqId, (seq, occurrence)) in batch.items():
+                entry = self.requests.get(reqId)
+                if entry is None:
+                    self.requests[reqId] = [self._encode(seq), occurrence]
+                    continue
+                if entry[0] is None:
+                    entry[0] = self._encode(seq)
+                entry[1] += occurrence
+
+    def get(self, reqId):
+        entry = self.requests.get(reqId)
+        return (self._decode(entry[0]),) if entry is not None else None
+
+    def get_most_hit(self, max_rows=10):
+        with self._lock:
+            top = heapq.nlargest(max_rows, self.requests.items(), key=lambda item: item[1][1])
+        return [(reqId, self._decode(seq), occurrence) for (reqId, (seq, occurrence)) in top]
+
+    def get_counts(self, max_rows=None):
+        with self._lock:
+            counts = [(reqId, occurrence) for (reqId, (_, occurrence)) in self.requests.items()]
+        counts.sort(key=lambda count: count[1], reverse=True)
+        return counts[:max_rows] if max_rows is not None else counts
+
+    def clear(self):
+        with self._lock:
+            self.requests.clear()
+
+class ShardedRequestsDB(RequestsStore):
+    """
+    Requests store spreading the requests over nb_shards SQLite dbs by the
+    hash of their id, "name.db" being split into "name.0.db", "name.1.db"...
+    Each shard has its own connection and its own write lock, committed as
+    soon as its part of a batch is written: the processes saving their
+    requests only wait for the ones writing the same shard, rather than for
+    every other flush.
+
+    A batch is atomic per shard only: if a shard fails, the others still save
+    their part of it, and PartialBatchError is raised with the records of the
+    failed shards. get_most_hit and get_counts merge the top requests of every
+    shard.
+
+    Use as following:
+        db = ShardedRequestsDB(".requests.db", nb_shards=4)
+        db.add_batch(recs)
+    """
+
+    def __init__(self, database=".requests.db", sequence_mode="full", compress_min_len=4096,
+                 nb_shards=4):
+        super().__init__(sequence_mode, compress_min_len)
+        if int(nb_shards) < 1:
+            raise ValueError(f"the number of shards ({nb_shards}) must be at least 1")
+        self.database = database
+        (root, ext) = os.path.splitext(database)
+        self.shards = [RequestsDB(f"{root}.{shard}{ext}", sequence_mode, compress_min_len)
+                       for shard in range(int(nb_shards))]
+
+    def shard(self, reqId):
+        """
+        Return the shard of a request, the same in every process.
+        """
+        return self.shards[zlib.crc32(reqId.encode()) % len(self.shards)]
+
+    def add_batch(self, recs, commit=True):
+        batches = {}
+        for (reqId, (seq, occurrence)) in self._merge(recs).items():
+            batches.setdefault(self.shard(reqId), []).append((reqId, seq, occurrence))
+        unsaved = []
+        error = None
+        for (shard, batch) in batches.items():
+            try:
+                shard.add_batch(batch, commit)
+            except Exception as err:
+                unsaved.extend(batch)
+                error = err
+        if error is not None:
+            raise PartialBatchError(f"{len(unsaved)} records not saved: {error}",
+                                    unsaved) from error
+
+    def get(self, reqId):
+        return self.shard(reqId).get(reqId)
+
+    def get_most_hit(self, max_rows=10):
+        # the max_rows most hit requests are among the max_rows most hit ones
+        # of their shard
+        tops = [shard.get_most_hit(max_rows) for shard in self.shards]
+        return list(islice(heapq.merge(*tops, key=lambda rec: rec[2], reverse=True),
+                           max_rows))
+
+    def get_counts(self, max_rows=None):
+        counts = [shard.get_counts(max_rows) for shard in self.shards]
+        return list(islice(heapq.merge(*counts, key=lambda count: count[1], reverse=True),
+                           max_rows))
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
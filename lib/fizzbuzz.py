@@ -1,8 +1,24 @@
 
+import json
+from math import gcd
+
 __all__ = (
     "FizzBuzzSeqGenerator",
+    "expand_pattern",
 )
 
+# must be a power of 10 so that the numbers of a block share their prefix
+BLOCK_SIZE = 1000
+# bound the memory used by the block templates of a sequence
+MAX_CACHED_TEMPLATES = 128
+# max number of substitution rules of a sequence
+MAX_RULES = 16
+# the strings of a period of at most this size are sieved once per sequence
+MAX_SIEVED_PERIOD = 65536
+# last digits of the numbers of a block, prefixed by the block number marker
+_BLOCK_SUFFIXES = tuple(
+    "_" + str(pos).zfill(len(str(BLOCK_SIZE)) - 1) for pos in range(BLOCK_SIZE))
+
 class FizzBuzzSeqGenerator:
     """
     FizzBuzz Sequence generator.
@@ -10,9 +26,23 @@ class FizzBuzzSeqGenerator:
     Use as following:
         fizzbuzz = FizzBuzz(3, 5, 100, "fizz", "buzz")
         seq = fizzbuzz.sequence()
+        fizzbuzz = FizzBuzz(limit=100, rules=[(3, "fizz"), (5, "buzz"), (7, "bazz")])
+
+    The sequence is defined by its ordered [divisor, string] rules, int1/str1
+    and int2/str2 being the two rules of the original fizzbuzz: a multiple of
+    some divisors is replaced by the concatenation of their strings, in the
+    order of the rules.
+
+    The replaced positions repeat with a period of the lcm of the divisors, so
+    the sequence is emitted by blocks of BLOCK_SIZE numbers: each block is
+    built from a template shared by all the blocks starting at the same offset
+    in the period, in which only the leading digits of the numbers change.
     """
 
-    def __init__(self, int1, int2, limit, str1, str2, maxLimit=1000000, maxStrLen=100):
+    BLOCK_SIZE = BLOCK_SIZE
+
+    def __init__(self, int1=None, int2=None, limit=None, str1=None, str2=None,
+                 maxLimit=1000000, maxStrLen=100, rules=None):
         self.maxLimit = maxLimit
         self.maxStrLen = maxStrLen
         self.int1 = int1
@@ -20,23 +50,63 @@ class FizzBuzzSeqGenerator:
         self.limit = limit
         self.str1 = str1
         self.str2 = str2
-        self._validate()
+        self.rules = rules
+        # escaped -> strings of a period sieved by _sieve
+        self._sieved = {}
+        if rules is None:
+            self._validate()
+        else:
+            self._validate_rules()
+        self._lcm = 1
+        for (divisor, _) in self.rules:
+            self._lcm = self._lcm * abs(divisor) // gcd(self._lcm, divisor)
+        self._escaped_rules = [(divisor, _json_escape(word)) for (divisor, word) in self.rules]
+
+    @classmethod
+    def from_req_id(cls, req_id, maxLimit=1000000):
+        """
+        Build the generator of a request identifier, as returned by req_id.
+        """
+        fields = req_id.split("_")
+        if fields[0] != "r":
+            return cls(*fields, maxLimit=maxLimit)
+        rules = list(zip(fields[2::2], fields[3::2]))
+        return cls(limit=fields[1], rules=rules, maxLimit=maxLimit)
+
+    def req_id(self):
+        """
+        Return the identifier of the sequence, from which from_req_id builds
+        it back: "int1_int2_limit_str1_str2" for two rules, otherwise
+        "r_limit_divisor1_string1_..._divisorN_stringN". It's built from the
+        validated values, so that the requests of a same sequence share it:
+        the divisors are positive and have no leading zeros.
+        """
+        rules = self.family()
+        if len(rules) == 2:
+            ((int1, str1), (int2, str2)) = rules
+            return f"{int1}_{int2}_{self.limit}_{str1}_{str2}"
+        return "_".join(["r", str(self.limit)]
+                        + [f"{divisor}_{word}" for (divisor, word) in rules])
+
+    def family(self):
+        """
+        Return the rules of the sequence as a tuple of (divisor, word), shared
+        by the sequences of any limit: a sequence is the prefix of the longer
+        ones of its family.
+        """
+        return tuple((abs(divisor), word) for (divisor, word) in self.rules)
 
     def _validate(self):
         try:
             self.int1 = int(self.int1)
             self.int2 = int(self.int2)
             self.limit = int(self.limit)
-        except ValueError:
+        except (TypeError, ValueError):
             raise ValueError("int1, int2 and limit must be integers")
 
         if not self.int1 or not self.int2:
             raise ValueError(f"int1 and int2 cannot be null")
-        if self.limit <= 1:
-            raise ValueError(f"the provided limit ({self.limit}) "
-                             "cannot be lower or equal to 1")
-        if self.limit > self.maxLimit:
-            raise ValueError(f"limit {self.limit} cannot be bigger that {self.maxLimit}")
+        self._validate_limit()
         if self.int1 > self.limit or self.int2 > self.limit:
             raise ValueError(f"int1 ({self.int1}) and int2 ({self.int2}) "
                              f"cannot be bigger than the limit ({self.limit})")
@@ -44,21 +114,225 @@ class FizzBuzzSeqGenerator:
             raise ValueError(f"str1 and str2 must be of type string")
         if len(self.str1) > self.maxStrLen or len(self.str2) > self.maxStrLen:
             raise ValueError(f"max len of str1 and str2 is {self.maxStrLen}")
+        self._validate_chars([self.str1, self.str2])
+        self.rules = [(self.int1, self.str1), (self.int2, self.str2)]
+
+    def _validate_rules(self):
+        if not isinstance(self.rules, (list, tuple)) or not self.rules:
+            raise ValueError("rules must be a non empty list of [divisor, string] pairs")
+        if len(self.rules) > MAX_RULES:
+            raise ValueError(f"rules cannot hold more than {MAX_RULES} rules")
+        try:
+            self.limit = int(self.limit)
+        except (TypeError, ValueError):
+            raise ValueError("limit must be an integer")
+        self._validate_limit()
+
+        rules = []
+        for rule in self.rules:
+            if not isinstance(rule, (list, tuple)) or len(rule) != 2:
+                raise ValueError("rules must be a non empty list of [divisor, string] pairs")
+            (divisor, word) = rule
+            try:
+                # parsed from its text as int1 and int2 are, so that the
+                # floats and the booleans are rejected rather than truncated
+                divisor = int(str(divisor))
+            except (TypeError, ValueError):
+                raise ValueError("the divisors of the rules must be integers")
+            if not divisor:
+                raise ValueError("the divisors of the rules cannot be null")
+            if divisor > self.limit:
+                raise ValueError(f"divisor ({divisor}) cannot be bigger than "
+                                 f"the limit ({self.limit})")
+            if not isinstance(word, str):
+                raise ValueError("the strings of the rules must be of type string")
+            if len(word) > self.maxStrLen:
+                raise ValueError(f"max len of the strings of the rules is {self.maxStrLen}")
+            rules.append((divisor, word))
+        self._validate_chars([word for (_, word) in rules])
+        self.rules = rules
+
+    def _validate_limit(self):
+        if self.limit <= 1:
+            raise ValueError(f"the provided limit ({self.limit}) "
+                             "cannot be lower or equal to 1")
+        if self.limit > self.maxLimit:
+            raise ValueError(f"limit {self.limit} cannot be bigger that {self.maxLimit}")
+
+    def _validate_chars(self, words):
         forbidden = [",", "_"]
         for car in forbidden:
-            if car in self.str1 or car in self.str2:
+            if any(car in word for word in words):
                 raise ValueError(f"characters {forbidden} are forbidden")
 
     def sequence(self):
+        return "".join(self._blocks(1, self.limit + 1))
+
+    def json_blocks(self):
+        """
+        Generate the sequence by blocks of UTF-8 encoded bytes, its strings
+        being JSON escaped, so that the blocks can be put as is between the
+        quotes of a JSON string. The blocks are built from bytes templates,
+        so the sequence is never encoded as a whole.
+
+        The block i ends with the element at position
+        min((i + 1) * BLOCK_SIZE - 1, limit), and the blocks after the first
+        one start with a ",".
+        """
+        return self._blocks(1, self.limit + 1, escaped=True)
+
+    def chunks(self, chunk_size=65536, escaped=False):
+        """
+        Generate the sequence by chunks of about chunk_size characters, the
+        last one being possibly smaller. Chunks are cut between two elements
+        of the sequence, so a chunk, except the first one, starts with a ",".
+        With escaped, the chunks are JSON escaped bytes, as json_blocks.
+        """
+        empty = b"" if escaped else ""
+        chunk = []
+        size = 0
+        for block in self._blocks(1, self.limit + 1, escaped):
+            chunk.append(block)
+            size += len(block)
+            if size >= chunk_size:
+                yield empty.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield empty.join(chunk)
+
+    def slice(self, offset, count, maxCount=None):
+        """
+        Return the elements [offset, offset + count) of the sequence, the
+        first element being at offset 0. The elements after the limit are
+        ignored. Only the returned elements are computed.
+        """
+        (offset, count) = self.validate_slice(offset, count, maxCount)
+        stop = min(offset + count, self.limit)
+        return "".join(self._blocks(offset + 1, stop + 1))
+
+    def validate_slice(self, offset, count, maxCount=None):
+        """
+        Return the (offset, count) of a slice as integers, raise ValueError
+        if they are invalid.
+        """
+        try:
+            offset = int(offset)
+            count = int(count)
+        except ValueError:
+            raise ValueError("offset and count must be integers")
+
+        if offset < 0 or offset >= self.limit:
+            raise ValueError(f"offset ({offset}) must be between 0 and "
+                             f"the limit ({self.limit}) excluded")
+        if count <= 0:
+            raise ValueError(f"count ({count}) must be positive")
+        if maxCount is not None and count > maxCount:
+            raise ValueError(f"count {count} cannot be bigger that {maxCount}")
+        return (offset, count)
+
+    def pattern(self):
+        """
+        Return the compact form of the sequence, whose size depends on the
+        period rather than on the limit:
+        - "replacements": the [position, string] of the replaced elements
+          among the positions 1 to period, which repeat every period;
+        - "rules": the [divisor, string] substitution rules;
+        - "limit" and "period", capped to the limit.
+        The other elements are their position. expand_pattern gives back the
+        sequence.
+        """
+        period = self.pattern_period()
+        tokens = self._replace([None] * period, 1)
+        return {
+            "limit": self.limit,
+            "period": period,
+            "separator": ",",
+            "rules": [[divisor, word] for (divisor, word) in self.rules],
+            "replacements": [[pos, token] for (pos, token) in enumerate(tokens, 1)
+                             if token is not None],
+        }
+
+    def estimated_size(self, count=None):
+        """
+        Return an upper bound of the size of count elements of the sequence,
+        all of them by default, without generating them.
+        """
+        count = self.limit if count is None else count
+        size = count * (len(str(self.limit)) + 1)
+        for (divisor, word) in self.rules:
+            size += count // abs(divisor) * len(word)
+        return size
+
+    def pattern_period(self):
+        """
+        Return the period of the pattern, which is also the cost of building it.
+        """
+        return min(self._period(), self.limit)
+
+    def _blocks(self, start, stop, escaped=False):
+        """
+        Generate the elements at the positions [start, stop) of the sequence,
+        the full blocks being built from their template. With escaped, the
+        blocks are bytes whose strings are JSON escaped.
+        """
+        size = BLOCK_SIZE
+        period = self._period()
+        # blocks in [first_block, last_block) are entirely in [start, stop)
+        first_block = -(-start // size)
+        last_block = stop // size
+        if first_block >= last_block:
+            # the elements are split between the two blocks they span, if any
+            middle = first_block * size
+            if start < middle < stop:
+                yield self._join(self._numbers(start, middle, escaped), escaped)
+                yield self._join([""] + self._numbers(middle, stop, escaped), escaped)
+            else:
+                yield self._join(self._numbers(start, stop, escaped), escaped)
+            return
+
+        # the elements before the first full block, which also holds the
+        # numbers lower than BLOCK_SIZE: they are not zero padded so they
+        # can't be built from a template.
+        head = start < first_block * size
+        if head:
+            yield self._join(self._numbers(start, first_block * size, escaped), escaped)
+
+        templates = {}
+        # templates are only kept if some blocks start at the same offset
+        nb_templates = period // gcd(period, size)
+        cache = (nb_templates < last_block - first_block
+                 and nb_templates <= MAX_CACHED_TEMPLATES)
+        for block in range(first_block, last_block):
+            offset = (block * size) % period
+            template = templates.get(offset)
+            if template is None:
+                template = self._template(offset, escaped)
+                if cache:
+                    templates[offset] = template
+            prefix = str(block)
+            content = (prefix.encode() if escaped else prefix).join(template)
+            if not head:
+                # drop the "," preceding the first element
+                content = content[1:]
+                head = True
+            yield content
+
+        if last_block * size < stop:
+            yield self._join([""] + self._numbers(last_block * size, stop, escaped), escaped)
+
+    def sequence_reference(self):
+        """
+        Straightforward implementation of the sequence, kept as a reference
+        for sequence().
+        """
         res = ""
         for pos in range(1, self.limit + 1):
             replaced = False
-            if not (pos % self.int1):
-                res += self.str1
-                replaced = True
-            if not (pos % self.int2):
-                res += self.str2
-                replaced = True
+            for (divisor, word) in self.rules:
+                if not (pos % divisor):
+                    res += word
+                    replaced = True
             if not replaced:
                 res += f"{pos}"
 
@@ -66,3 +340,97 @@ class FizzBuzzSeqGenerator:
 
         # remove the trailing ","
         return res[:-1]
+
+    def _period(self):
+        return self._lcm
+
+    def _replace(self, tokens, start, escaped=False):
+        """
+        Replace the multiples of the divisors in tokens, tokens[0] being the
+        element at position start, and return them.
+
+        Each rule is applied with a strided slice assignment, so the cost is
+        the number of replaced elements rather than the number of tokens.
+        With up to two rules, the common multiples are replaced last by the
+        concatenated strings. With more rules, the strings of each position
+        are concatenated by a sieve, and copied over the tokens.
+        """
+        size = len(tokens)
+        rules = self._escaped_rules if escaped else self.rules
+        if len(rules) > 2:
+            return self._sieve(tokens, start, escaped)
+        steps = [(abs(divisor), word) for (divisor, word) in rules]
+        if len(rules) == 2:
+            steps.append((self._period(), rules[0][1] + rules[1][1]))
+        for (step, word) in steps:
+            first = (-start) % step
+            if first < size:
+                tokens[first::step] = [word] * len(range(first, size, step))
+        return tokens
+
+    def _sieve(self, tokens, start, escaped):
+        size = len(tokens)
+        period = self._period()
+        if period > MAX_SIEVED_PERIOD:
+            words = self._sieve_words(start, size, escaped)
+        else:
+            # the words of the positions are read from the sieved period,
+            # which starts at a multiple of the period
+            sieved = self._sieved.get(escaped)
+            if sieved is None:
+                sieved = self._sieved[escaped] = self._sieve_words(0, period, escaped)
+            words = []
+            offset = start % period
+            while len(words) < size:
+                words += sieved[offset:offset + size - len(words)]
+                offset = 0
+        return [token if word is None else word for (token, word) in zip(tokens, words)]
+
+    def _sieve_words(self, start, size, escaped):
+        """
+        Return the concatenated strings of the positions [start, start + size),
+        None for the positions which are not replaced.
+        """
+        words = [None] * size
+        for (divisor, word) in (self._escaped_rules if escaped else self.rules):
+            step = abs(divisor)
+            first = (-start) % step
+            if first < size:
+                words[first::step] = [word if prev is None else prev + word
+                                      for prev in words[first::step]]
+        return words
+
+    def _numbers(self, start, stop, escaped=False):
+        return self._replace([str(pos) for pos in range(start, stop)], start, escaped)
+
+    @staticmethod
+    def _join(tokens, escaped):
+        elements = ",".join(tokens)
+        return elements.encode() if escaped else elements
+
+    def _template(self, offset, escaped=False):
+        """
+        Build the template of a block starting at the given offset in the
+        period. Joining it with the block number gives the block content,
+        preceded by a ",". The "_" character, forbidden in the strings, is
+        used to mark where the block number goes.
+        """
+        tokens = self._replace(list(_BLOCK_SUFFIXES), offset, escaped)
+        return self._join([""] + tokens, escaped).split(b"_" if escaped else "_")
+
+def _json_escape(word):
+    """
+    Escape word to be put between the quotes of a JSON string, as ASCII. "/"
+    is escaped as well, so that the concatenated strings of a position never
+    hold an unescaped "</", as json_encode does.
+    """
+    return json.dumps(word)[1:-1].replace("/", "\\/")
+
+def expand_pattern(pattern):
+    """
+    Reference expander of FizzBuzzSeqGenerator.pattern, return the sequence.
+    """
+    period = pattern["period"]
+    replacements = dict(pattern["replacements"])
+    return pattern["separator"].join(replacements.get((pos - 1) % period + 1, str(pos))
+                                     for pos in range(1, pattern["limit"] + 1))
@@ -0,0 +1,167 @@
+from bisect import bisect_left
+
+__all__ = (
+    "MetricsRegistry",
+)
+
+# upper bounds of the default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds of the default size buckets, in bytes
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+class _Metric:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # label values -> child holding the values of these labels
+        self.children = {}
+
+    def labels(self, *values):
+        """
+        Return the child of the given label values. Children should be kept
+        by the callers on the hot paths, to save the lookup.
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _labels(self, values, extra=None):
+        pairs = list(zip(self.labelnames, values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        labels = ",".join(f'{name}="{_escape(value)}"' for (name, value) in pairs)
+        return "{" + labels + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for (values, child) in sorted(self.children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    _new_child = _CounterChild
+
+    def inc(self, value=1):
+        self.labels().inc(value)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._labels(values)} {child.value}"]
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # counts[i] is the number of values in (buckets[i - 1], buckets[i]],
+        # the last one the number of values above the last bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        total = 0
+        for (bound, count) in zip(self.buckets + ("+Inf",), child.counts):
+            total += count
+            lines.append(f"{self.name}_bucket{self._labels(values, ('le', bound))} {total}")
+        lines.append(f"{self.name}_sum{self._labels(values)} {child.sum}")
+        lines.append(f"{self.name}_count{self._labels(values)} {total}")
+        return lines
+
+class CallbackMetric(_Metric):
+    """
+    Metric whose values are only read when rendered, from func() returning
+    either a value or a {label values: value} dict.
+    """
+
+    def __init__(self, name, help, func, type="gauge", labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.func = func
+        self.TYPE = type
+
+    def render(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for (labels, value) in sorted(values.items()):
+            lines.append(f"{self.name}{self._labels(labels)} {value}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Metrics rendered in the Prometheus text format.
+
+    Recording a value only costs a few additions, values computed elsewhere
+    are read from callbacks when the metrics are rendered. The metrics are not
+    locked: each one should only be recorded from a single thread.
+
+    Use as following:
+        metrics = MetricsRegistry("fizzbuzz")
+        latency = metrics.histogram("request_duration_seconds", "Requests latency",
+                                    ["handler"]).labels("sequence")
+        latency.observe(0.002)
+        metrics.callback("queue_pending", "Pending requests", lambda: len(queue))
+        metrics.render()
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, prefix=""):
+        self.prefix = f"{prefix}_" if prefix else ""
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(self.prefix + name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labelnames, buckets))
+
+    def callback(self, name, help, func, type="gauge", labelnames=()):
+        return self._add(CallbackMetric(self.prefix + name, help, func, type, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
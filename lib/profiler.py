@@ -0,0 +1,171 @@
+from collections import Counter
+import cProfile
+import os
+import sys
+import threading
+import time
+
+__all__ = (
+    "Profiler",
+    "StackSampler",
+)
+
+PROFILE_MODES = ("sample", "cprofile")
+
+class StackSampler:
+    """
+    Sample the stacks of all the threads of the process every interval seconds,
+    from its own thread. Its cost doesn't depend on the number of calls made by
+    the profiled code, so it can run on a loaded server.
+
+    The samples are written in the collapsed stacks format, one
+    "thread;outer function;...;inner function count" line per distinct stack,
+    as read by flamegraph.pl or speedscope.
+
+    Use as following:
+        sampler = StackSampler()
+        sampler.start()
+        ...
+        sampler.stop()
+        sampler.write("profile.txt")
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = float(interval)
+        # collapsed stack -> number of samples
+        self.counts = Counter()
+        self.nb_samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="fizzbuzz-sampler",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as output:
+            for (stack, count) in self.counts.most_common():
+                output.write(f"{stack} {count}\n")
+
+    def _run(self):
+        ident = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} "
+                                 f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.nb_samples += 1
+
+class Profiler:
+    """
+    On demand profiling of the running process, the outputs being written in
+    directory. A session profiles the process until it's stopped:
+    - the "sample" mode samples the stacks of all the threads with a
+      StackSampler, written in the collapsed stacks format;
+    - the "cprofile" mode profiles the thread calling start and stop with
+      cProfile, written as pstats.
+
+    A single request can also be profiled with cProfile, between
+    start_request and stop_request. Since cProfile profiles everything run by
+    the thread meanwhile, a single request is profiled at a time and not
+    during a cprofile session.
+
+    Use as following:
+        profiler = Profiler("/tmp/fizzbuzz-profiles")
+        profiler.start("sample")
+        ...
+        path = profiler.stop()
+    """
+
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = float(interval)
+        # (mode, sampler or cProfile.Profile, output path) of the running session
+        self.session = None
+        self.request_profile = None
+        self.nb_outputs = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, mode="sample"):
+        """
+        Start a session, return the path its output will be written to.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+        if self.session is not None:
+            raise RuntimeError(f"a {self.session[0]} profiling session is already running")
+        if mode == "cprofile":
+            if self.request_profile is not None:
+                raise RuntimeError("a request is being profiled")
+            profile = cProfile.Profile()
+            profile.enable()
+            path = self._new_path("cprofile", "pstats")
+        else:
+            profile = StackSampler(self.interval)
+            profile.start()
+            path = self._new_path("sample", "txt")
+        self.session = (mode, profile, path)
+        return path
+
+    def stop(self):
+        """
+        Stop the running session and write its output, return its path or
+        None if no session is running.
+        """
+        if self.session is None:
+            return None
+        (mode, profile, path) = self.session
+        self.session = None
+        if mode == "cprofile":
+            profile.disable()
+            profile.dump_stats(path)
+        else:
+            profile.stop()
+            profile.write(path)
+        return path
+
+    def start_request(self):
+        """
+        Start profiling a request, return the path its profile will be written
+        to, or None if it cannot be profiled now.
+        """
+        if self.request_profile is not None or (
+                self.session is not None and self.session[0] == "cprofile"):
+            return None
+        path = self._new_path("request", "pstats")
+        profile = cProfile.Profile()
+        self.request_profile = (profile, path)
+        profile.enable()
+        return path
+
+    def stop_request(self):
+        if self.request_profile is None:
+            return None
+        (profile, path) = self.request_profile
+        self.request_profile = None
+        profile.disable()
+        profile.dump_stats(path)
+        return path
+
+    def stats(self):
+        return {
+            "running": self.session[0] if self.session is not None else None,
+            "outputs": self.nb_outputs,
+        }
+
+    def _new_path(self, kind, ext):
+        self.nb_outputs += 1
+        name = f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self.nb_outputs}.{ext}"
+        return os.path.join(self.directory, name)
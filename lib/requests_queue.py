@@ -0,0 +1,68 @@
+import time
+
+__all__ = (
+    "RequestsQueue",
+)
+
+class RequestsQueue:
+    """
+    Requests waiting to be saved in the db, aggregated by request id: the memory
+    used grows with the number of distinct requests, not with the number of
+    requests.
+
+    Use as following:
+        queue = RequestsQueue()
+        queue.add("3_5_100_fizz_buzz", seq)
+        db.add_batch(queue.take())
+    """
+
+    def __init__(self):
+        # req_id -> [sequence, number of requests]
+        self.pending = {}
+        # number of requests aggregated in pending
+        self.nb_requests = 0
+        # time of the oldest request in pending
+        self.oldest = None
+        # age of the oldest request saved by the last flush
+        self.last_flush_lag = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, reqId, seq=None):
+        entry = self.pending.get(reqId)
+        if entry is None:
+            self.pending[reqId] = [seq, 1]
+        else:
+            entry[0] = entry[0] if entry[0] is not None else seq
+            entry[1] += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        self.nb_requests += 1
+
+    def take(self):
+        """
+        Empty the queue and return its content as (reqId, seq, occurrence)
+        records, as expected by RequestsDB.add_batch.
+        """
+        recs = [(reqId, seq, occurrence)
+                for (reqId, (seq, occurrence)) in self.pending.items()]
+        self.last_flush_lag = self.lag()
+        self.pending = {}
+        self.nb_requests = 0
+        self.oldest = None
+        return recs
+
+    def lag(self):
+        """
+        Number of seconds the oldest pending request has been waiting for.
+        """
+        return time.monotonic() - self.oldest if self.oldest is not None else 0
+
+    def stats(self):
+        return {
+            "pending_keys": len(self.pending),
+            "pending_requests": self.nb_requests,
+            "lag": self.lag(),
+            "last_flush_lag": self.last_flush_lag,
+        }
@@ -0,0 +1,52 @@
+import asyncio
+
+__all__ = (
+    "SingleFlight",
+)
+
+class SingleFlight:
+    """
+    Coalesce the concurrent computations of a same key: the first caller starts
+    the computation and the following ones wait for its result, until it's done.
+
+    The result, or the exception, is returned to every caller. The computation
+    runs in its own task, so that a caller being cancelled doesn't cancel it for
+    the other callers.
+
+    Use as following:
+        flights = SingleFlight()
+        seq = await flights.run("3_5_100_fizz_buzz", compute_sequence)
+    """
+
+    def __init__(self):
+        # key -> future of the running computation
+        self.flights = {}
+        # number of computations started
+        self.nb_started = 0
+        # number of callers which waited for a computation started by another one
+        self.nb_coalesced = 0
+
+    def __len__(self):
+        return len(self.flights)
+
+    async def run(self, key, func):
+        """
+        Return the result of func(), a coroutine function, or the one of the
+        running computation of key.
+        """
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.flights[key] = future
+            future.add_done_callback(lambda _: self.flights.pop(key, None))
+            self.nb_started += 1
+        else:
+            self.nb_coalesced += 1
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {
+            "running": len(self.flights),
+            "started": self.nb_started,
+            "coalesced": self.nb_coalesced,
+        }
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+from admission import AdmissionControl, AdmissionError
+
+class TestAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_fast_lane(self):
+        admission = AdmissionControl(heavy_min_cost=100, max_heavy=0, max_waiting=0)
+
+        async def run():
+            async with admission.admit(99) as heavy:
+                return heavy
+
+        self.assertFalse(self.loop.run_until_complete(run()))
+        self.assertEqual(admission.stats(), {
+            "running": 0, "waiting": 0, "fast": 1, "heavy": 0, "rejected": 0})
+
+    def test_heavy_lane(self):
+        admission = AdmissionControl(heavy_min_cost=100, max_heavy=2, max_waiting=2)
+        running = []
+        order = []
+
+        async def compute(value):
+            async with admission.admit(100) as heavy:
+                self.assertTrue(heavy)
+                running.append(value)
+                self.assertLessEqual(admission.nb_running, 2)
+                await asyncio.sleep(0.01)
+                order.append(value)
+            return value
+
+        async def burst():
+            return await asyncio.gather(*[compute(value) for value in range(5)],
+                                        return_exceptions=True)
+
+        res = self.loop.run_until_complete(burst())
+        # 2 run, 2 wait for their turn in order, the last one is rejected
+        self.assertEqual(res[:4], [0, 1, 2, 3])
+        self.assertIsInstance(res[4], AdmissionError)
+        self.assertEqual(order, [0, 1, 2, 3])
+        self.assertEqual(admission.stats(), {
+            "running": 0, "waiting": 0, "fast": 0, "heavy": 4, "rejected": 1})
+
+    def test_no_reject(self):
+        admission = AdmissionControl(heavy_min_cost=1, max_heavy=1, max_waiting=0)
+        order = []
+
+        async def compute(value, reject):
+            async with admission.admit(1, reject):
+                await asyncio.sleep(0.01)
+                order.append(value)
+
+        async def burst():
+            return await asyncio.gather(compute(0, True), compute(1, True), compute(2, False),
+                                        return_exceptions=True)
+
+        res = self.loop.run_until_complete(burst())
+        # the one which can't be rejected waits for its turn
+        self.assertIsInstance(res[1], AdmissionError)
+        self.assertEqual(order, [0, 2])
+        self.assertEqual(admission.stats()["running"], 0)
+
+    def test_cancelled_waiter(self):
+        admission = AdmissionControl(heavy_min_cost=1, max_heavy=1, max_waiting=1)
+
+        async def compute():
+            async with admission.admit(1):
+                await asyncio.sleep(0.01)
+
+        async def burst():
+            first = asyncio.ensure_future(compute())
+            second = asyncio.ensure_future(compute())
+            await asyncio.sleep(0)
+            second.cancel()
+            await first
+            # the slot is free again
+            await compute()
+
+        self.loop.run_until_complete(burst())
+        self.assertEqual(admission.stats()["running"], 0)
+        self.assertEqual(admission.stats()["waiting"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import unittest
+
+from cache import PrefixIndex, SequenceCache
+
+def entry_size(key, value):
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+class TestSequenceCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = SequenceCache()
+        self.assertEqual(cache.get("3_5_20_fizz_buzz"), None)
+        self.assertTrue(cache.put("3_5_20_fizz_buzz", "toto"))
+        self.assertEqual(cache.get("3_5_20_fizz_buzz"), "toto")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, entry_size("3_5_20_fizz_buzz", "toto"))
+
+        stats = cache.stats()
+        self.assertEqual(stats.get("hits"), 1)
+        self.assertEqual(stats.get("misses"), 1)
+        self.assertEqual(stats.get("evictions"), 0)
+
+    def test_replace(self):
+        cache = SequenceCache()
+        cache.put("a", "toto")
+        cache.put("a", "titi" * 10)
+        self.assertEqual(cache.get("a"), "titi" * 10)
+        self.assertEqual(cache.size, entry_size("a", "titi" * 10))
+
+    def test_lru_eviction(self):
+        cache = SequenceCache(max_bytes=3 * entry_size("a", "x" * 100))
+        for key in ["a", "b", "c"]:
+            cache.put(key, "x" * 100)
+        # "a" becomes the most recently used so "b" is evicted
+        cache.get("a")
+        cache.put("d", "x" * 100)
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn("b", cache)
+        for key in ["a", "c", "d"]:
+            self.assertIn(key, cache)
+        self.assertEqual(cache.keys(), ["c", "a", "d"])
+
+        # a big entry evicts as many entries as needed
+        cache.put("e", "x" * 200)
+        self.assertEqual(len(cache), 2)
+        self.assertIn("d", cache)
+        self.assertIn("e", cache)
+        self.assertEqual(cache.evictions, 3)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_given_size(self):
+        cache = SequenceCache()
+        cache.put("a", ("toto", "titi"), size=1000)
+        self.assertEqual(cache.size, sys.getsizeof("a") + 1000)
+
+    def test_too_big_entry(self):
+        cache = SequenceCache(max_bytes=100)
+        self.assertFalse(cache.put("a", "x" * 100))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_clear(self):
+        cache = SequenceCache()
+        cache.put("a", "toto")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+class TestPrefixIndex(unittest.TestCase):
+    def test_find(self):
+        cache = SequenceCache()
+        index = PrefixIndex(cache)
+        for length in [100, 1000, 10]:
+            cache.put(f"a_{length}", "x" * length)
+            index.add("a", length, f"a_{length}")
+        cache.put("b_50", "y" * 50)
+        index.add("b", 50, "b_50")
+
+        self.assertEqual(index.find("a", 50), (100, "x" * 100))
+        self.assertEqual(index.find("a", 100), (100, "x" * 100))
+        self.assertEqual(index.find("a", 5), (10, "x" * 10))
+        self.assertIsNone(index.find("a", 1001))
+        self.assertIsNone(index.find("c", 1))
+        self.assertEqual(index.find("b", 20), (50, "y" * 50))
+        self.assertEqual(index.stats(), {"families": 2, "entries": 4, "hits": 4, "misses": 2})
+
+    def test_evicted(self):
+        cache = SequenceCache()
+        index = PrefixIndex(cache)
+        for length in [100, 1000]:
+            cache.put(f"a_{length}", "x" * length)
+            index.add("a", length, f"a_{length}")
+        cache.remove("a_100")
+        self.assertEqual(index.find("a", 50), (1000, "x" * 1000))
+        self.assertEqual(len(index), 1)
+        cache.remove("a_1000")
+        self.assertIsNone(index.find("a", 50))
+        self.assertEqual(index.stats()["families"], 0)
+
+    def test_remove(self):
+        cache = SequenceCache()
+        index = PrefixIndex(cache)
+        for length in [100, 1000]:
+            cache.put(f"a_{length}", "x" * length)
+            index.add("a", length, f"a_{length}")
+        index.remove("a", 100, "a_100")
+        index.remove("a", 100, "a_100")
+        index.remove("b", 100, "b_100")
+        self.assertEqual(index.find("a", 50), (1000, "x" * 1000))
+        self.assertEqual(len(index), 1)
+        index.remove("a", 1000, "a_1000")
+        self.assertIsNone(index.find("a", 50))
+        self.assertEqual(index.stats()["families"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import glob
+import os
+import sqlite3
 import unittest
 
-from db import RequestsDB
+from db import (MemoryRequestsDB, PartialBatchError, RequestsDB, RequestsStore,
+                ShardedRequestsDB)
 
 class TestRequestsDB(unittest.TestCase):
+    DATABASE = ".test_add"
+
     def setUp(self):
-        self.db = RequestsDB(database=".test_add")
+        self.db = RequestsDB(database=self.DATABASE)
 
     def tearDown(self):
-        self.db.clear()
+        self.db.close()
+        for path in glob.glob(self.DATABASE + "*"):
+            os.remove(path)
 
     def test_add_requests(self):
         db = self.db
@@ -26,6 +34,37 @@ class TestRequestsDB(unittest.TestCase):
         want = set([('3_5_20_fizz_buzz', 'toto', 2), ('test', 'titi', 1), ('tata', 'titi', 1)])
         self.assertEqual(want, set(recs))
 
+    def test_add_batch(self):
+        db = self.db
+        db.add("3_5_20_fizz_buzz", "toto")
+        db.add_batch([
+            ("3_5_20_fizz_buzz", "toto"),
+            ("test", None),
+            ("3_5_20_fizz_buzz", "toto"),
+            ("test", "titi"),
+            ("tata", None, 5),
+        ])
+
+        self.assertEqual(db.get_most_hit(), [
+            ("tata", None, 5), ("3_5_20_fizz_buzz", "toto", 3), ("test", "titi", 2)])
+
+    def test_failed_batch(self):
+        db = self.db
+        db.add("a", None)
+        # the second record cannot be bound, the first one must not be counted
+        with self.assertRaises(sqlite3.Error):
+            db.add_batch([("a", None), ("b", None, [1])])
+        self.assertEqual(db.get_counts(), [("a", 1)])
+
+    def test_quoted_request(self):
+        db = self.db
+        reqId = '3_5_20_fi"zz_bu\'zz'
+        db.add(reqId, 'fi"zz')
+        db.add(reqId, 'fi"zz')
+
+        self.assertEqual(db.get(reqId), ('fi"zz',))
+        self.assertEqual(db.get_most_hit(), [(reqId, 'fi"zz', 2)])
+
     def test_get_req(self):
         db = self.db
         db.add("3_5_20_fizz_buzz", "toto")
@@ -36,6 +75,13 @@ class TestRequestsDB(unittest.TestCase):
         rec = db.get("toto")
         self.assertEqual(rec, None)
 
+    def test_add_without_sequence(self):
+        db = self.db
+        db.add("3_5_200000_fizz_buzz", None)
+
+        rec = db.get("3_5_200000_fizz_buzz")
+        self.assertEqual(rec, (None,))
+
     def test_most_hit(self):
         db = self.db
         db.add("3_5_20_fizz_buzz", "toto")
@@ -56,5 +102,166 @@ class TestRequestsDB(unittest.TestCase):
         res = db.get_most_hit(max_rows=3)
         self.assertEqual(len(res), 2)
 
+    def test_counts(self):
+        db = self.db
+        db.add_batch([("3_5_20_fizz_buzz", "toto", 3), ("test", "titi", 1), ("tata", None, 2)])
+
+        res = db.get_counts()
+        self.assertEqual(res, [("3_5_20_fizz_buzz", 3), ("tata", 2), ("test", 1)])
+        res = db.get_counts(max_rows=1)
+        self.assertEqual(res, [("3_5_20_fizz_buzz", 3)])
+
+class TestRequestsDBSequenceModes(unittest.TestCase):
+    DATABASE = ".test_modes"
+
+    def setUp(self):
+        self.dbs = []
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+        for path in glob.glob(self.DATABASE + "*"):
+            os.remove(path)
+
+    def open_db(self, **kwargs):
+        db = RequestsDB(database=self.DATABASE, **kwargs)
+        self.dbs.append(db)
+        return db
+
+    def test_unknown_mode(self):
+        with self.assertRaisesRegex(ValueError, "unknown sequence mode"):
+            self.open_db(sequence_mode="invalid")
+
+    def test_compressed(self):
+        db = self.open_db(sequence_mode="compressed", compress_min_len=10)
+        db.add("3_5_20_fizz_buzz", "toto" * 10)
+        db.add("test", "titi")
+
+        con = db.get_db_connection()
+        sql = "select id, typeof(sequence) from requests"
+        recs = con.cursor().execute(sql).fetchall()
+        self.assertEqual(set(recs), set([("3_5_20_fizz_buzz", "blob"), ("test", "text")]))
+
+        self.assertEqual(db.get("3_5_20_fizz_buzz"), ("toto" * 10,))
+        self.assertEqual(db.get("test"), ("titi",))
+        res = db.get_most_hit()
+        self.assertEqual(set(res), set([("3_5_20_fizz_buzz", "toto" * 10, 1), ("test", "titi", 1)]))
+
+    def test_none(self):
+        db = self.open_db(sequence_mode="none")
+        db.add("3_5_20_fizz_buzz", "toto")
+        db.add("3_5_20_fizz_buzz", "toto")
+
+        self.assertEqual(db.get("3_5_20_fizz_buzz"), (None,))
+        self.assertEqual(db.get_most_hit(), [("3_5_20_fizz_buzz", None, 2)])
+
+    def test_migration(self):
+        # db created before the sequence modes
+        con = sqlite3.connect(self.DATABASE)
+        con.execute("CREATE TABLE requests (id text PRIMARY KEY, sequence text, "
+                    "occurrence integer default 0)")
+        con.execute("INSERT INTO requests VALUES ('3_5_20_fizz_buzz', 'toto', 3)")
+        con.commit()
+        con.close()
+
+        db = self.open_db(sequence_mode="compressed", compress_min_len=1)
+        con = db.get_db_connection()
+        sql = "select typeof(sequence) from requests"
+        self.assertEqual(con.cursor().execute(sql).fetchone(), ("blob",))
+        self.assertEqual(db.get_most_hit(), [("3_5_20_fizz_buzz", "toto", 3)])
+        self.assertEqual(con.execute("PRAGMA user_version").fetchone(), (1,))
+
+        db = self.open_db(sequence_mode="none")
+        db.rewrite_sequences()
+        self.assertEqual(db.get_most_hit(), [("3_5_20_fizz_buzz", None, 3)])
+
+class TestRequestsStore(unittest.TestCase):
+    def test_abstract(self):
+        class PartialStore(RequestsStore):
+            def add_batch(self, recs, commit=True):
+                pass
+
+        with self.assertRaises(TypeError):
+            RequestsStore()
+        with self.assertRaises(TypeError):
+            PartialStore()
+
+class TestMemoryRequestsDB(unittest.TestCase):
+    def test_add_batch(self):
+        db = MemoryRequestsDB()
+        db.add("3_5_20_fizz_buzz", None)
+        db.add_batch([
+            ("3_5_20_fizz_buzz", "toto"),
+            ("test", None),
+            ("3_5_20_fizz_buzz", "titi"),
+            ("tata", None, 5),
+        ])
+        self.assertEqual(len(db), 3)
+        self.assertEqual(db.get("3_5_20_fizz_buzz"), ("toto",))
+        self.assertEqual(db.get("test"), (None,))
+        self.assertIsNone(db.get("toto"))
+        self.assertEqual(db.get_most_hit(2), [("tata", None, 5), ("3_5_20_fizz_buzz", "toto", 3)])
+        self.assertEqual(db.get_counts(), [("tata", 5), ("3_5_20_fizz_buzz", 3), ("test", 1)])
+        db.clear()
+        self.assertEqual(db.get_counts(), [])
+
+    def test_compressed(self):
+        db = MemoryRequestsDB(sequence_mode="compressed", compress_min_len=10)
+        db.add("3_5_20_fizz_buzz", "toto" * 10)
+        self.assertIsInstance(db.requests["3_5_20_fizz_buzz"][0], bytes)
+        self.assertEqual(db.get("3_5_20_fizz_buzz"), ("toto" * 10,))
+
+class TestShardedRequestsDB(unittest.TestCase):
+    DATABASE = ".test_shards.db"
+
+    def setUp(self):
+        self.db = ShardedRequestsDB(database=self.DATABASE, nb_shards=3)
+
+    def tearDown(self):
+        self.db.close()
+        for path in glob.glob(".test_shards.*"):
+            os.remove(path)
+
+    def test_shards(self):
+        db = self.db
+        reqIds = [f"3_5_{limit}_fizz_buzz" for limit in range(20, 80)]
+        db.add_batch((reqId, None, occurrence) for (occurrence, reqId) in enumerate(reqIds))
+        db.add_batch([(reqIds[0], "toto"), (reqIds[0], None, 99)])
+        # the requests are spread over every shard, each request in a single one
+        counts = [len(shard.get_counts()) for shard in db.shards]
+        self.assertEqual(sum(counts), len(reqIds))
+        self.assertTrue(all(counts))
+
+        self.assertEqual(db.get(reqIds[0]), ("toto",))
+        # another process finds the requests in the same shards
+        other = ShardedRequestsDB(database=self.DATABASE, nb_shards=3)
+        self.assertEqual(other.get(reqIds[0]), ("toto",))
+        other.close()
+        self.assertIsNone(db.get("toto"))
+        self.assertEqual(db.get_most_hit(3), [(reqIds[0], "toto", 100), (reqIds[-1], None, 59),
+                                              (reqIds[-2], None, 58)])
+        self.assertEqual(db.get_counts(2), [(reqIds[0], 100), (reqIds[-1], 59)])
+        self.assertEqual(len(db.get_counts()), len(reqIds))
+        db.clear()
+        self.assertEqual(db.get_counts(), [])
+
+    def test_partial_batch(self):
+        db = self.db
+        reqIds = [f"3_5_{limit}_fizz_buzz" for limit in range(20, 80)]
+        locked = db.shards[1]
+        def add_batch(recs, commit=True):
+            raise sqlite3.OperationalError("database is locked")
+        locked.add_batch = add_batch
+        with self.assertRaises(PartialBatchError) as ctx:
+            db.add_batch((reqId, None) for reqId in reqIds)
+        # the other shards saved their part of the batch
+        unsaved = set(reqId for (reqId, _, _) in ctx.exception.recs)
+        self.assertEqual(unsaved, set(reqId for reqId in reqIds if db.shard(reqId) is locked))
+        self.assertEqual(set(reqId for (reqId, _) in db.get_counts()), set(reqIds) - unsaved)
+
+    def test_invalid_shards(self):
+        with self.assertRaisesRegex(ValueError, "must be at least 1"):
+            ShardedRequestsDB(database=self.DATABASE, nb_shards=0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import json
 import unittest
 
-from fizzbuzz import FizzBuzzSeqGenerator
+from fizzbuzz import FizzBuzzSeqGenerator, expand_pattern
 
 class TestFizzBuzzSeqGenerator(unittest.TestCase):
     def test_int_as_invalid_str(self):
@@ -54,6 +55,161 @@ class TestFizzBuzzSeqGenerator(unittest.TestCase):
             want = "1,2,fizz,4,buzz,fizz,7,8,fizz,buzz,11,fizz,13,14,fizzbuzz,16,17,fizz,19,buzz"
             self.assertEqual(seq, want)
 
+    def test_sequence_matches_reference(self):
+        for (int1, int2, limit) in [
+            (2, 2, 2), (3, 5, 999), (3, 5, 1000), (3, 5, 1001),
+            (3, 5, 123456), (7, 11, 50000), (1, 1, 5000), (4, 6, 20000),
+            (-3, 5, 20000), (999, 997, 200000), (2, 9973, 30000),
+            (1000, 2000, 10000), (16, 125, 40000),
+        ]:
+            fizzbuzz = FizzBuzzSeqGenerator(int1, int2, limit, "fizz", "buzz")
+            self.assertEqual(fizzbuzz.sequence(), fizzbuzz.sequence_reference())
+
+    def test_pattern(self):
+        fizzbuzz = FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz")
+        self.assertEqual(fizzbuzz.pattern(), {
+            "limit": 20,
+            "period": 15,
+            "separator": ",",
+            "rules": [[3, "fizz"], [5, "buzz"]],
+            "replacements": [[3, "fizz"], [5, "buzz"], [6, "fizz"], [9, "fizz"],
+                             [10, "buzz"], [12, "fizz"], [15, "fizzbuzz"]],
+        })
+
+    def test_pattern_expands_to_sequence(self):
+        for (int1, int2, limit) in [
+            (2, 2, 2), (3, 5, 1000), (3, 5, 123456), (1, 1, 5000), (4, 6, 20000),
+            (-3, 5, 20000), (999, 997, 200000), (2, 9973, 30000), (16, 125, 40000),
+        ]:
+            fizzbuzz = FizzBuzzSeqGenerator(int1, int2, limit, "fizz", "buzz")
+            # as sent by the server
+            pattern = json.loads(json.dumps(fizzbuzz.pattern()))
+            self.assertEqual(expand_pattern(pattern).encode(), fizzbuzz.sequence().encode())
+
+    def test_rules(self):
+        fizzbuzz = FizzBuzzSeqGenerator(limit=21, rules=[[3, "fizz"], [5, "buzz"], [7, "bazz"]])
+        self.assertEqual(fizzbuzz.sequence(), "1,2,fizz,4,buzz,fizz,bazz,8,fizz,buzz,11,"
+                                              "fizz,13,bazz,fizzbuzz,16,17,fizz,19,buzz,fizzbazz")
+        # the two rules form is the original fizzbuzz
+        fizzbuzz = FizzBuzzSeqGenerator(limit=20, rules=[("3", "fizz"), ("5", "buzz")])
+        self.assertEqual(fizzbuzz.sequence(), FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz").sequence())
+
+    def test_rules_match_reference(self):
+        for (rules, limit) in [
+            ([(3, "fizz")], 5000),
+            ([(3, "fizz"), (5, "buzz"), (7, "bazz")], 123456),
+            ([(2, "a"), (3, "b"), (4, "c"), (6, "d")], 20000),
+            ([(7, "x"), (-7, "y"), (11, "z")], 30000),
+            ([(2, "a"), (3, "b"), (5, "c"), (7, "d"), (11, "e"), (13, "f")], 50000),
+            ([(1000, ""), (125, "q"), (8, "w")], 10000),
+        ]:
+            fizzbuzz = FizzBuzzSeqGenerator(limit=limit, rules=rules)
+            self.assertEqual(fizzbuzz.sequence(), fizzbuzz.sequence_reference())
+            pattern = json.loads(json.dumps(fizzbuzz.pattern()))
+            self.assertEqual(expand_pattern(pattern), fizzbuzz.sequence())
+
+    def test_invalid_rules(self):
+        for (rules, want) in [
+            ([], "rules must be a non empty list"),
+            ([(3, "fizz", "buzz")], "rules must be a non empty list"),
+            ([(3, "fizz")] * 17, "rules cannot hold more than 16 rules"),
+            ([("invalid", "fizz")], "the divisors of the rules must be integers"),
+            ([(3.9, "fizz")], "the divisors of the rules must be integers"),
+            ([(True, "fizz")], "the divisors of the rules must be integers"),
+            ([(0, "fizz")], "the divisors of the rules cannot be null"),
+            ([(30, "fizz")], r"divisor \(30\) cannot be bigger than the limit \(20\)"),
+            ([(3, 3)], "the strings of the rules must be of type string"),
+            ([(3, "f_zz")], "characters .* are forbidden"),
+        ]:
+            with self.assertRaisesRegex(ValueError, want):
+                FizzBuzzSeqGenerator(limit=20, rules=rules)
+
+    def test_req_id(self):
+        for (fizzbuzz, want) in [
+            (FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz"), "3_5_20_fizz_buzz"),
+            (FizzBuzzSeqGenerator(limit=20, rules=[(3, "fizz"), (5, "buzz")]), "3_5_20_fizz_buzz"),
+            (FizzBuzzSeqGenerator(limit=20, rules=[(3, "fizz"), (5, "buzz"), (7, "")]),
+             "r_20_3_fizz_5_buzz_7_"),
+            (FizzBuzzSeqGenerator(limit=20, rules=[(3, "fizz")]), "r_20_3_fizz"),
+            # equivalent requests share their id
+            (FizzBuzzSeqGenerator(" 03", "-5", "020", "fizz", "buzz"), "3_5_20_fizz_buzz"),
+        ]:
+            self.assertEqual(fizzbuzz.req_id(), want)
+            built = FizzBuzzSeqGenerator.from_req_id(want)
+            self.assertEqual(built.req_id(), want)
+            self.assertEqual(built.sequence(), fizzbuzz.sequence())
+            self.assertEqual(built.family(), fizzbuzz.family())
+
+    def test_estimated_size(self):
+        for fizzbuzz in [
+            FizzBuzzSeqGenerator(3, 5, 100000, "fizz", "buzz"),
+            FizzBuzzSeqGenerator(2, 3, 1000, "a" * 100, "b" * 100),
+            FizzBuzzSeqGenerator(limit=30000, rules=[(2, "a"), (3, "b"), (5, "c")]),
+        ]:
+            size = len(fizzbuzz.sequence())
+            self.assertGreaterEqual(fizzbuzz.estimated_size(), size)
+            self.assertLess(fizzbuzz.estimated_size(), size * 3)
+
+    def test_chunks(self):
+        fizzbuzz = FizzBuzzSeqGenerator(3, 5, 100000, "fizz", "buzz")
+        chunks = list(fizzbuzz.chunks(chunk_size=10000))
+        self.assertEqual("".join(chunks), fizzbuzz.sequence())
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 10000)
+        for chunk in chunks[1:]:
+            self.assertTrue(chunk.startswith(","))
+
+    def test_json_blocks(self):
+        for fizzbuzz in [
+            FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz"),
+            FizzBuzzSeqGenerator(7, 11, 100000, 'fi"zz\\', "bü</zz"),
+            FizzBuzzSeqGenerator(limit=30000, rules=[(2, "<"), (3, "/b"), (5, "\n")]),
+        ]:
+            body = b"".join(fizzbuzz.json_blocks())
+            self.assertEqual(json.loads(b'"' + body + b'"'), fizzbuzz.sequence())
+            self.assertNotIn(b"</", body)
+            self.assertEqual(b"".join(fizzbuzz.chunks(chunk_size=10000, escaped=True)), body)
+
+    def test_json_blocks_ends(self):
+        size = FizzBuzzSeqGenerator.BLOCK_SIZE
+        for limit in [5, 999, 1000, 1001, 2500, 12000]:
+            fizzbuzz = FizzBuzzSeqGenerator(3, 5, limit, "fizz", "buzz")
+            nb_elements = 0
+            for (i, block) in enumerate(fizzbuzz.json_blocks()):
+                self.assertEqual(block.startswith(b","), i > 0)
+                nb_elements += block.count(b",") + (i == 0)
+                self.assertEqual(nb_elements, min((i + 1) * size - 1, limit))
+            self.assertEqual(nb_elements, limit)
+
+    def test_slice(self):
+        fizzbuzz = FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz")
+        self.assertEqual(fizzbuzz.slice(0, 3), "1,2,fizz")
+        self.assertEqual(fizzbuzz.slice(13, 3), "14,fizzbuzz,16")
+        self.assertEqual(fizzbuzz.slice(18, 10), "19,buzz")
+
+        fizzbuzz = FizzBuzzSeqGenerator(7, 11, 100000, "fizz", "buzz")
+        elements = fizzbuzz.sequence().split(",")
+        for (offset, count) in [(0, 1), (76, 77), (5000, 12345), (99999, 1),
+                                (998, 2000), (999, 2000), (1000, 3001), (0, 100000)]:
+            want = ",".join(elements[offset:offset + count])
+            self.assertEqual(fizzbuzz.slice(offset, count), want)
+
+    def test_slice_huge_limit(self):
+        fizzbuzz = FizzBuzzSeqGenerator(3, 5, 10**15, "fizz", "buzz", maxLimit=10**15)
+        self.assertEqual(fizzbuzz.slice(10**15 - 3, 5), "999999999999998,fizz,buzz")
+
+    def test_slice_out_of_range(self):
+        fizzbuzz = FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz")
+        with self.assertRaisesRegex(ValueError, "offset and count must be integers"):
+            fizzbuzz.slice("invalid", 3)
+        for offset in [-1, 20]:
+            with self.assertRaisesRegex(ValueError, "offset (.*) must be between 0"):
+                fizzbuzz.slice(offset, 3)
+        with self.assertRaisesRegex(ValueError, "count (.*) must be positive"):
+            fizzbuzz.slice(0, 0)
+        with self.assertRaisesRegex(ValueError, "count 10 cannot be bigger that 5"):
+            fizzbuzz.slice(0, 10, maxCount=5)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from metrics import MetricsRegistry
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_counter(self):
+        metrics = MetricsRegistry("fizzbuzz")
+        counter = metrics.counter("lookups_total", "Lookups", ["result"])
+        counter.labels("hit").inc()
+        counter.labels("hit").inc(2)
+        counter.labels("miss").inc()
+        self.assertEqual(metrics.render(), "\n".join([
+            "# HELP fizzbuzz_lookups_total Lookups",
+            "# TYPE fizzbuzz_lookups_total counter",
+            'fizzbuzz_lookups_total{result="hit"} 3',
+            'fizzbuzz_lookups_total{result="miss"} 1',
+        ]) + "\n")
+
+    def test_histogram(self):
+        metrics = MetricsRegistry()
+        histogram = metrics.histogram("size", "Sizes", buckets=[10, 100])
+        for value in [1, 10, 50, 1000]:
+            histogram.observe(value)
+        self.assertEqual(metrics.render(), "\n".join([
+            "# HELP size Sizes",
+            "# TYPE size histogram",
+            'size_bucket{le="10"} 2',
+            'size_bucket{le="100"} 3',
+            'size_bucket{le="+Inf"} 4',
+            "size_sum 1061",
+            "size_count 4",
+        ]) + "\n")
+
+    def test_callback(self):
+        metrics = MetricsRegistry()
+        queue = [1, 2]
+        metrics.callback("pending", "Pending", lambda: len(queue))
+        metrics.callback("cache_total", "Cache", lambda: {("hit",): 5, ('"x"',): 1},
+                         "counter", ["result"])
+        queue.append(3)
+        self.assertEqual(metrics.render(), "\n".join([
+            "# HELP pending Pending",
+            "# TYPE pending gauge",
+            "pending 3",
+            "# HELP cache_total Cache",
+            "# TYPE cache_total counter",
+            'cache_total{result="\\"x\\""} 1',
+            'cache_total{result="hit"} 5',
+        ]) + "\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from profiler import Profiler, StackSampler
+
+def compute():
+    return sum(range(1000))
+
+def busy_loop(stop):
+    while not stop.is_set():
+        compute()
+
+class TestStackSampler(unittest.TestCase):
+    def test_sample(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,), name="busy")
+        thread.start()
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        time.sleep(0.1)
+        sampler.stop()
+        stop.set()
+        thread.join()
+
+        self.assertGreater(sampler.nb_samples, 0)
+        busy = [stack for stack in sampler.counts if stack.startswith("busy;")]
+        self.assertTrue(busy)
+        self.assertIn("busy_loop (test_profiler.py:", busy[0])
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(self.directory, interval=0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sample(self):
+        path = self.profiler.start("sample")
+        self.assertEqual(self.profiler.stats().get("running"), "sample")
+        with self.assertRaisesRegex(RuntimeError, "already running"):
+            self.profiler.start("cprofile")
+        time.sleep(0.05)
+        self.assertEqual(self.profiler.stop(), path)
+        self.assertIsNone(self.profiler.stop())
+        with open(path) as output:
+            self.assertTrue(output.read())
+
+    def test_cprofile(self):
+        path = self.profiler.start("cprofile")
+        compute()
+        self.profiler.stop()
+        stats = pstats.Stats(path)
+        self.assertTrue(any(func[2] == "compute" for func in stats.stats))
+
+    def test_request(self):
+        path = self.profiler.start_request()
+        # a single request is profiled at a time
+        self.assertIsNone(self.profiler.start_request())
+        compute()
+        self.assertEqual(self.profiler.stop_request(), path)
+        stats = pstats.Stats(path)
+        self.assertTrue(any(func[2] == "compute" for func in stats.stats))
+
+        self.profiler.start("cprofile")
+        self.assertIsNone(self.profiler.start_request())
+        self.profiler.stop()
+
+    def test_unknown_mode(self):
+        with self.assertRaisesRegex(ValueError, "unknown profile mode"):
+            self.profiler.start("invalid")
+
+if __name__ == "__main__":
+    unittest.main()
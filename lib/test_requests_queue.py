@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from requests_queue import RequestsQueue
+
+class TestRequestsQueue(unittest.TestCase):
+    def test_add_take(self):
+        queue = RequestsQueue()
+        queue.add("3_5_20_fizz_buzz", "toto")
+        queue.add("test")
+        queue.add("3_5_20_fizz_buzz", "toto")
+        queue.add("test", "titi")
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.nb_requests, 4)
+        recs = queue.take()
+        self.assertEqual(set(recs), set([("3_5_20_fizz_buzz", "toto", 2), ("test", "titi", 2)]))
+
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.nb_requests, 0)
+        self.assertEqual(queue.take(), [])
+
+    def test_lag(self):
+        queue = RequestsQueue()
+        self.assertEqual(queue.lag(), 0)
+        queue.add("test")
+        time.sleep(0.01)
+        queue.add("test")
+        self.assertGreaterEqual(queue.lag(), 0.01)
+
+        queue.take()
+        self.assertEqual(queue.lag(), 0)
+        self.assertGreaterEqual(queue.last_flush_lag, 0.01)
+
+        stats = queue.stats()
+        self.assertEqual(stats.get("pending_keys"), 0)
+        self.assertEqual(stats.get("pending_requests"), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+from singleflight import SingleFlight
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_coalesce(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def compute(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        async def burst():
+            return await asyncio.gather(
+                *[flights.run("a", lambda: compute(1)) for _ in range(10)],
+                flights.run("b", lambda: compute(2)),
+            )
+
+        res = self.loop.run_until_complete(burst())
+        self.assertEqual(res, [1] * 10 + [2])
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(flights.stats(), {"running": 0, "started": 2, "coalesced": 9})
+
+        # a new computation is started once the previous one is done
+        res = self.loop.run_until_complete(flights.run("a", lambda: compute(3)))
+        self.assertEqual(res, 3)
+
+    def test_error(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("failure")
+
+        async def burst():
+            return await asyncio.gather(
+                *[flights.run("a", fail) for _ in range(3)], return_exceptions=True)
+
+        res = self.loop.run_until_complete(burst())
+        self.assertEqual([str(err) for err in res], ["failure"] * 3)
+        self.assertEqual(len(flights), 0)
+
+    def test_cancelled_caller(self):
+        flights = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            return 1
+
+        async def burst():
+            first = asyncio.ensure_future(flights.run("a", compute))
+            second = asyncio.ensure_future(flights.run("a", compute))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        # the computation goes on for the remaining caller
+        self.assertEqual(self.loop.run_until_complete(burst()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
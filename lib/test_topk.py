@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+import random
+import unittest
+
+from topk import SketchTopRequests, TopRequests
+
+class TestTopRequests(unittest.TestCase):
+    def test_top(self):
+        top = TopRequests(k=2)
+        self.assertEqual(top.top(), [])
+        top.add("a")
+        self.assertEqual(top.top(), [("a", 1)])
+        top.add("b", 2)
+        top.add("c", 3)
+        self.assertEqual(top.top(), [("c", 3), ("b", 2)])
+        # "a" leaves the top once more frequent than "b"
+        top.add("a", 2)
+        self.assertEqual(top.top(), [("a", 3), ("c", 3)])
+        top.add("b", 5)
+        self.assertEqual(top.top(), [("b", 7), ("c", 3)])
+
+    def test_seed(self):
+        top = TopRequests(k=2)
+        top.seed([("a", 10), ("b", 5), ("c", 1)])
+        top.add("c", 5)
+        self.assertEqual(top.top(), [("a", 10), ("c", 6)])
+
+    def test_reset(self):
+        for top in [TopRequests(k=2), SketchTopRequests(k=2, capacity=4)]:
+            top.seed([("a", 10), ("b", 5)])
+            top.reset([("b", 3), ("c", 1)])
+            self.assertEqual(top.top(), [("b", 3), ("c", 1)])
+
+    def test_random_stream(self):
+        rand = random.Random(0)
+        keys = [str(int(rand.paretovariate(1))) for _ in range(20000)]
+        top = TopRequests(k=10)
+        for key in keys:
+            top.add(key)
+        counts = Counter(keys)
+        want = sorted(counts.items(), key=lambda rec: (-rec[1], rec[0]))[:10]
+        self.assertEqual(top.top(), want)
+
+class TestSketchTopRequests(unittest.TestCase):
+    def test_exact_under_capacity(self):
+        top = SketchTopRequests(k=2, capacity=3)
+        top.seed([("a", 1), ("b", 2), ("c", 3)])
+        self.assertEqual(top.top(), [("c", 3), ("b", 2)])
+
+    def test_eviction(self):
+        top = SketchTopRequests(k=2, capacity=2)
+        top.seed([("a", 5), ("b", 1)])
+        # "c" takes over the counter of "b"
+        top.add("c")
+        self.assertEqual(top.top(), [("a", 5), ("c", 2)])
+
+    def test_heavy_hitters(self):
+        rand = random.Random(0)
+        keys = [str(int(rand.paretovariate(1))) for _ in range(20000)]
+        top = SketchTopRequests(k=5, capacity=50)
+        for key in keys:
+            top.add(key)
+        counts = Counter(keys)
+        want = [key for (key, _) in counts.most_common(5)]
+        self.assertEqual(set(key for (key, _) in top.top()), set(want))
+        for (key, count) in top.top():
+            self.assertGreaterEqual(count, counts[key])
+
+if __name__ == "__main__":
+    unittest.main()
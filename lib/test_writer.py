@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import sqlite3
+import threading
+import unittest
+
+from db import RequestsDB, ShardedRequestsDB
+from writer import RequestsWriter
+
+class BlockingDB:
+    """
+    DB whose add_batch waits for the release event.
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.recs = []
+
+    def add_batch(self, recs):
+        self.release.wait()
+        self.recs.extend(recs)
+
+class LockedDB(RequestsDB):
+    """
+    DB whose first nb_failures add_batch fail as if it was locked.
+    """
+
+    def __init__(self, nb_failures, **kwargs):
+        super().__init__(**kwargs)
+        self.nb_failures = nb_failures
+
+    def add_batch(self, recs, commit=True):
+        if self.nb_failures > 0:
+            self.nb_failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        super().add_batch(recs, commit)
+
+class TestRequestsWriter(unittest.TestCase):
+    def setUp(self):
+        self.db = RequestsDB(database=".test_add")
+
+    def tearDown(self):
+        self.db.clear()
+
+    def test_add_batch(self):
+        writes = []
+        writer = RequestsWriter(RequestsDB(database=".test_add"),
+                                on_write=lambda nb_recs, duration: writes.append(nb_recs))
+        writer.start()
+        self.assertTrue(writer.add_batch([("3_5_20_fizz_buzz", "toto", 2)]))
+        self.assertTrue(writer.add_batch([("3_5_20_fizz_buzz", "toto", 1), ("test", None, 1)]))
+        self.assertTrue(writer.stop(timeout=5))
+        self.assertEqual(sum(writes), 3)
+
+        res = self.db.get_most_hit()
+        self.assertEqual(res, [("3_5_20_fizz_buzz", "toto", 3), ("test", None, 1)])
+        self.assertEqual(writer.stats().get("pending_batches"), 0)
+
+    def test_drop_policy(self):
+        db = BlockingDB()
+        writer = RequestsWriter(db, max_pending=1, policy="drop")
+        writer.start()
+        # the first batch is taken by the writer thread which is then blocked
+        self.assertTrue(writer.add_batch([("a", None, 1)]))
+        self.assertFalse(writer.drain(timeout=0.1))
+        self.assertTrue(writer.add_batch([("b", None, 1)]))
+        self.assertFalse(writer.add_batch([("c", None, 1), ("d", None, 1)]))
+        self.assertEqual(writer.nb_dropped, 2)
+
+        db.release.set()
+        self.assertTrue(writer.stop(timeout=5))
+        self.assertEqual(db.recs, [("a", None, 1), ("b", None, 1)])
+
+    def test_full(self):
+        writer = RequestsWriter(BlockingDB(), max_pending=1)
+        self.assertFalse(writer.full())
+        self.assertTrue(writer.add_batch([("a", None, 1)]))
+        self.assertTrue(writer.full())
+
+    def test_retry(self):
+        writer = RequestsWriter(LockedDB(2, database=".test_add"), retry_delay=0.01)
+        writer.start()
+        self.assertTrue(writer.add_batch([("3_5_20_fizz_buzz", None, 2)]))
+        self.assertTrue(writer.add_batch([("3_5_20_fizz_buzz", None, 1), ("test", None, 1)]))
+        self.assertTrue(writer.stop(timeout=5))
+        # no request is lost nor counted twice
+        self.assertEqual(self.db.get_counts(), [("3_5_20_fizz_buzz", 3), ("test", 1)])
+        self.assertEqual(writer.stats(), {
+            "pending_batches": 0, "written": 3, "dropped": 0, "errors": 2, "retrying": 0})
+
+    def test_drop_on_stop(self):
+        writer = RequestsWriter(LockedDB(100, database=".test_add"), retry_delay=0.01)
+        writer.start()
+        writer.add_batch([("a", None, 1)])
+        # the batch is retried until the writer is stopped
+        self.assertFalse(writer.stop(timeout=0.1))
+        self.assertTrue(writer.drain(timeout=5))
+        self.assertEqual(writer.nb_dropped, 1)
+        self.assertEqual(self.db.get_counts(), [])
+
+    def test_retry_sharded(self):
+        db = ShardedRequestsDB(database=".test_writer.db", nb_shards=2)
+        self.addCleanup(lambda: [os.remove(path) for path in glob.glob(".test_writer.*")])
+        # the first shard is locked by another process once
+        db.shards[0].close()
+        db.shards[0] = LockedDB(1, database=db.shards[0].database)
+        writer = RequestsWriter(db, retry_delay=0.01)
+        writer.start()
+        recs = [(f"3_5_{limit}_fizz_buzz", None, 1) for limit in range(20)]
+        writer.add_batch(recs)
+        self.assertTrue(writer.stop(timeout=5))
+        # the shard which saved its part of the batch doesn't count it twice
+        self.assertEqual(sorted(db.get_counts()), sorted((rec[0], 1) for rec in recs))
+        self.assertEqual(writer.stats()["written"], 20)
+        self.assertEqual(writer.stats()["errors"], 1)
+        db.close()
+
+    def test_unknown_policy(self):
+        with self.assertRaisesRegex(ValueError, "unknown writer policy"):
+            RequestsWriter(self.db, policy="invalid")
+
+if __name__ == "__main__":
+    unittest.main()
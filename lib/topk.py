@@ -0,0 +1,162 @@
+import heapq
+
+__all__ = (
+    "TopRequests",
+    "SketchTopRequests",
+)
+
+class _IndexedMinHeap:
+    """
+    Min heap of [count, key] entries, indexed by key so that the count of any
+    entry can be increased in O(log n).
+    """
+
+    def __init__(self):
+        self.heap = []
+        # key -> position of its entry in heap
+        self.index = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def min(self):
+        return self.heap[0]
+
+    def items(self):
+        return ((key, count) for (count, key) in self.heap)
+
+    def push(self, key, count):
+        self.heap.append([count, key])
+        self.index[key] = len(self.heap) - 1
+        self._sift_up(len(self.heap) - 1)
+
+    def increase(self, key, delta):
+        pos = self.index[key]
+        self.heap[pos][0] += delta
+        self._sift_down(pos)
+
+    def replace_min(self, key, count):
+        """
+        Replace the entry with the lowest count by a new one, return the
+        replaced [count, key] entry.
+        """
+        replaced = self.heap[0]
+        del self.index[replaced[1]]
+        self.heap[0] = [count, key]
+        self.index[key] = 0
+        self._sift_down(0)
+        return replaced
+
+    def _swap(self, i, j):
+        heap = self.heap
+        (heap[i], heap[j]) = (heap[j], heap[i])
+        self.index[heap[i][1]] = i
+        self.index[heap[j][1]] = j
+
+    def _sift_up(self, pos):
+        while pos:
+            parent = (pos - 1) // 2
+            if self.heap[parent] <= self.heap[pos]:
+                return
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        heap = self.heap
+        size = len(heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and heap[child] < heap[smallest]:
+                    smallest = child
+            if smallest == pos:
+                return
+            self._swap(pos, smallest)
+            pos = smallest
+
+class TopRequests:
+    """
+    Exact top k of the most frequent requests, updated as requests are counted.
+
+    The count of every request is kept, along with a min heap of the k most
+    frequent ones: counting a request takes O(log k) and getting the top k
+    takes O(k log k).
+
+    Use as following:
+        top = TopRequests(10)
+        top.seed(db.get_counts())
+        top.add("3_5_100_fizz_buzz")
+        top.top()
+    """
+
+    def __init__(self, k=10):
+        self.k = int(k)
+        self.counts = {}
+        self._top = _IndexedMinHeap()
+
+    def add(self, key, count=1):
+        total = self.counts.get(key, 0) + count
+        self.counts[key] = total
+        if key in self._top:
+            self._top.increase(key, count)
+        elif len(self._top) < self.k:
+            self._top.push(key, total)
+        elif total > self._top.min()[0]:
+            self._top.replace_min(key, total)
+
+    def seed(self, recs):
+        """
+        Count the given (key, count) records, as returned by RequestsDB.get_counts.
+        """
+        for (key, count) in recs:
+            self.add(key, count)
+
+    def reset(self, recs=()):
+        """
+        Forget all the counts, then count the given (key, count) records.
+        """
+        self.counts = {}
+        self._top = _IndexedMinHeap()
+        self.seed(recs)
+
+    def top(self):
+        """
+        Return the k most frequent (key, count), from the most to the least
+        frequent.
+        """
+        return sorted(self._top.items(), key=lambda rec: (-rec[1], rec[0]))
+
+class SketchTopRequests(TopRequests):
+    """
+    Approximate top k of the most frequent requests, using the Space-Saving
+    algorithm: only capacity counters are kept whatever the number of distinct
+    requests. Once all the counters are used, a new request takes over the
+    counter of the least frequent one, and inherits its count.
+
+    Counts are over estimated by at most the lowest count, and any request more
+    frequent than total / capacity is guaranteed to be counted.
+    """
+
+    def __init__(self, k=10, capacity=1000):
+        super().__init__(k)
+        self.capacity = max(int(capacity), self.k)
+        self._counters = _IndexedMinHeap()
+
+    def reset(self, recs=()):
+        self._counters = _IndexedMinHeap()
+        self.seed(recs)
+
+    def add(self, key, count=1):
+        if key in self._counters:
+            self._counters.increase(key, count)
+        elif len(self._counters) < self.capacity:
+            self._counters.push(key, count)
+        else:
+            self._counters.replace_min(key, self._counters.min()[0] + count)
+
+    def top(self):
+        return sorted(heapq.nlargest(self.k, self._counters.items(), key=lambda rec: rec[1]),
+                      key=lambda rec: (-rec[1], rec[0]))
@@ -0,0 +1,176 @@
+import logging
+import queue
+import threading
+import time
+
+__all__ = (
+    "RequestsWriter",
+)
+
+LOGGER = logging.getLogger("fizzbuzz.writer")
+
+WRITER_POLICIES = ("block", "drop")
+
+class RequestsWriter:
+    """
+    Save the requests batches in a db from a dedicated thread, so that the
+    callers never wait for the db.
+
+    The writer thread is the only user of the given db, which must not be
+    shared with other threads, unless it's a MemoryRequestsDB. Batches are
+    queued until the writer thread saves them, the batches queued meanwhile
+    being saved in a single transaction. At most max_pending batches can be
+    queued: once the queue is full, the "block" policy makes add_batch wait
+    for a free slot while the "drop" policy drops the batch: the callers
+    which can't wait check full() first. on_write, if given, is called from
+    the writer thread after each write with the number of records written
+    and the time it took.
+
+    A batch which fails to be saved, e.g. when the db is locked by another
+    process for too long, is retried along with the batches queued meanwhile,
+    after retry_delay seconds doubled at each failure up to max_retry_delay.
+    It's only dropped when it fails once the writer is stopping. When the db
+    saved a part of the batch, its error holds the unsaved records as recs,
+    e.g. PartialBatchError, and only them are retried.
+
+    Use as following:
+        writer = RequestsWriter(RequestsDB(".requests.db"))
+        writer.start()
+        writer.add_batch(recs)
+        writer.stop(timeout=5)
+    """
+
+    def __init__(self, db, max_pending=100, policy="block", on_write=None,
+                 retry_delay=0.1, max_retry_delay=5):
+        if policy not in WRITER_POLICIES:
+            raise ValueError(f"unknown writer policy {policy}, "
+                             f"expected one of {WRITER_POLICIES}")
+        self.db = db
+        self.policy = policy
+        self.on_write = on_write
+        self.retry_delay = float(retry_delay)
+        self.max_retry_delay = float(max_retry_delay)
+        self.queue = queue.Queue(int(max_pending))
+        self.nb_written = 0
+        self.nb_dropped = 0
+        self.nb_errors = 0
+        # records which failed to be saved, retried with the next batches
+        self.nb_retrying = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="fizzbuzz-writer",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def add_batch(self, recs):
+        """
+        Queue a batch of records as expected by RequestsDB.add_batch, return
+        False if it's dropped.
+        """
+        try:
+            self.queue.put(recs, block=self.policy == "block")
+        except queue.Full:
+            self.nb_dropped += len(recs)
+            LOGGER.warning("writer queue is full, %d records dropped", len(recs))
+            return False
+        return True
+
+    def full(self):
+        """
+        Return True if add_batch would wait for a free slot, or drop the batch.
+        """
+        return self.queue.full()
+
+    def drain(self, timeout=None):
+        """
+        Wait for the queued batches to be saved, return False if they are not
+        all saved before the timeout.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Save the queued batches and stop the writer thread, return False if
+        they are not all saved before the timeout: the batches failing to be
+        saved from then on are dropped.
+        """
+        drained = self.drain(timeout)
+        if drained:
+            self.queue.put(None)
+            self._thread.join()
+        else:
+            self._stopping.set()
+        return drained
+
+    def stats(self):
+        return {
+            "pending_batches": self.queue.qsize(),
+            "written": self.nb_written,
+            "dropped": self.nb_dropped,
+            "errors": self.nb_errors,
+            "retrying": self.nb_retrying,
+        }
+
+    def _take(self, block):
+        """
+        Return all the queued batches, waiting for one if block is True.
+        """
+        batches = [self.queue.get()] if block else []
+        while True:
+            try:
+                batches.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def _run(self):
+        # records which failed to be saved, and the number of queued batches
+        # they come from, done once they are saved
+        failed = []
+        nb_failed_batches = 0
+        delay = self.retry_delay
+        while True:
+            if failed:
+                self._stopping.wait(delay)
+            # save all the queued batches at once
+            batches = self._take(block=not failed)
+            stop = None in batches
+            recs = failed + [rec for batch in batches if batch is not None for rec in batch]
+            nb_batches = nb_failed_batches + len(batches)
+            try:
+                if recs:
+                    start = time.monotonic()
+                    self.db.add_batch(recs)
+                    self.nb_written += len(recs)
+                    if self.on_write is not None:
+                        self.on_write(len(recs), time.monotonic() - start)
+                delay = self.retry_delay
+            except Exception as err:
+                self.nb_errors += 1
+                # the db rolled the batch back, or the part of it which isn't
+                # saved for the dbs whose batches are not atomic
+                unsaved = getattr(err, "recs", recs)
+                self.nb_written += len(recs) - len(unsaved)
+                recs = unsaved
+                if not (stop or self._stopping.is_set()):
+                    LOGGER.exception("unable to save %d records, retried in %.1fs",
+                                     len(recs), delay)
+                    (failed, nb_failed_batches) = (recs, nb_batches)
+                    self.nb_retrying = len(recs)
+                    delay = min(delay * 2, self.max_retry_delay)
+                    continue
+                self.nb_dropped += len(recs)
+                LOGGER.exception("unable to save %d records, dropped", len(recs))
+            (failed, nb_failed_batches) = ([], 0)
+            self.nb_retrying = 0
+            for _ in range(nb_batches):
+                self.queue.task_done()
+            if stop:
+                return
@@ -1,6 +1,20 @@
 #!/usr/bin/env sh
 
+poetry run python3 lib/test_admission.py
 poetry run python3 lib/test_fizzbuzz.py
 poetry run python3 lib/test_db.py
+poetry run python3 lib/test_cache.py
+poetry run python3 lib/test_metrics.py
+poetry run python3 lib/test_profiler.py
+poetry run python3 lib/test_requests_queue.py
+poetry run python3 lib/test_singleflight.py
+poetry run python3 lib/test_topk.py
+poetry run python3 lib/test_writer.py
 poetry run python3 -m tornado.testing test_server.py
 poetry run python3 -m tornado.testing test_load_server.py
+
+# microbenchmarks, compared against the saved baseline
+if [ "$1" = "--bench" ]; then
+    poetry run python3 bench.py --baseline bench_baseline.json \
+        --threshold "${FIZZBUZZ_BENCH_THRESHOLD:-0.3}"
+fi
@@ -1,38 +1,466 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from array import array
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor)
 from functools import partial
+from itertools import (accumulate, chain)
+import gzip
+import hashlib
 import logging
+import multiprocessing
 import os
 import signal
 import sys
 import time
 
 from tornado.escape import (json_decode, json_encode)
-from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import (IOLoop, PeriodicCallback)
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
 from tornado.web import (RequestHandler, Application)
 
-from lib.db import RequestsDB
+from lib.admission import (AdmissionControl, AdmissionError)
+from lib.cache import (PrefixIndex, SequenceCache)
+from lib.db import (MemoryRequestsDB, RequestsDB, ShardedRequestsDB)
 from lib.fizzbuzz import FizzBuzzSeqGenerator
+from lib.metrics import (MetricsRegistry, SIZE_BUCKETS)
+from lib.profiler import Profiler
+from lib.requests_queue import RequestsQueue
+from lib.singleflight import SingleFlight
+from lib.topk import (SketchTopRequests, TopRequests)
+from lib.writer import RequestsWriter
 
 logging.basicConfig(format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
 LOGGER = logging.getLogger("fizzbuzz")
 LOGGER.setLevel(logging.INFO)
 IS_SERVER_STARTED = False
-REQUESTS_QUEUE = []
-MOST_QUERIED = {}
-STATS_CACHE = None
+REQUESTS_QUEUE = RequestsQueue()
 
 __all__ = (
     "getApp",
+    "get_executor",
+    "get_requests_db",
 )
 
 # {{{ Helpers
 
-def flush_queue(db):
-    global REQUESTS_QUEUE
-    db.add_batch(REQUESTS_QUEUE)
-    REQUESTS_QUEUE = []
+def flush_queue(db, writer=None, wait=False):
+    """
+    Save the pending requests in the db, or hand them over to the writer
+    which saves them from its own thread when there's one.
+
+    When the writer is full, its "block" policy only waits for it if wait is
+    True, e.g. on shutdown: otherwise the requests are kept in the queue
+    until the writer catches up, rather than blocking the IOLoop.
+    """
+    if not REQUESTS_QUEUE:
+        return
+    if (writer is not None and writer.policy == "block" and not wait
+            and writer.full()):
+        return
+    recs = REQUESTS_QUEUE.take()
+    if writer is not None:
+        writer.add_batch(recs)
+        LOGGER.info("%d requests handed to the writer, waited up to %.3fs",
+                    len(recs), REQUESTS_QUEUE.last_flush_lag)
+        return
+    start = time.monotonic()
+    db.add_batch(recs)
+    LOGGER.info("%d requests saved in %.3fs, waited up to %.3fs",
+                len(recs), time.monotonic() - start, REQUESTS_QUEUE.last_flush_lag)
+
+async def sync_top_requests(db, writer, top_requests, max_rows=None):
+    """
+    Reset the top requests to the counts saved in the db, which include the
+    requests served by the other server processes, plus the pending requests
+    of this process.
+    """
+    flush_queue(db, writer)
+    if writer is not None:
+        await IOLoop.current().run_in_executor(None, writer.drain, 1)
+    recs = await IOLoop.current().run_in_executor(None, db.get_counts, max_rows)
+    top_requests.reset(recs)
+    for (req_id, (_, count)) in REQUESTS_QUEUE.pending.items():
+        top_requests.add(req_id, count)
+
+def fork_workers(nb_processes, signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Fork nb_processes server processes and return the index of the current one
+    in the children. The parent process forwards the given signals to the
+    children, waits for them to exit then exits.
+    """
+    children = {}
+    for i in range(nb_processes):
+        pid = os.fork()
+        if pid == 0:
+            return i
+        children[pid] = i
+
+    def forward_signal(signum, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for sig in signals:
+        signal.signal(sig, forward_signal)
+    while children:
+        try:
+            (pid, status) = os.wait()
+        except ChildProcessError:
+            break
+        # a process killed by a signal exits with the negated signal number
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if code != 0:
+            LOGGER.warning("server process %d exited with code %d", children[pid], code)
+        children.pop(pid, None)
+    sys.exit(0)
+
+def start_profiling(profiler, mode="sample", seconds=30):
+    """
+    Start a profiling session stopped after the given seconds, return the
+    path of its output.
+    """
+    path = profiler.start(mode)
+    LOGGER.info("%s profiling started for %ss, written to %s", mode, seconds, path)
+
+    def stop_profiling():
+        LOGGER.info("profile written to %s", profiler.stop())
+
+    IOLoop.current().call_later(seconds, stop_profiling)
+    return path
+
+def get_executor(kind="thread", workers=None):
+    """
+    Return the executor generating the sequences: a thread pool, or a process
+    pool whose generations are not serialized by the GIL. Processes are
+    spawned rather than forked, since forking a process running threads is
+    unsafe.
+    """
+    workers = int(workers) if workers else None
+    if kind == "thread":
+        return ThreadPoolExecutor(workers)
+    if kind == "process":
+        if sys.version_info < (3, 7):
+            # the pool can't be given its context before Python 3.7, it uses
+            # the default one: the server uses multiprocessing for it only
+            multiprocessing.set_start_method("spawn", force=True)
+            return ProcessPoolExecutor(workers)
+        return ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"))
+    raise ValueError(f"unknown executor {kind}, expected thread or process")
+
+def get_requests_db(backend="sqlite", database=".fizzbuzz.db", sequence_mode="none",
+                    compress_min_len=4096, nb_shards=4):
+    """
+    Return the store of the requests: a single SQLite db, the requests sharded
+    over nb_shards SQLite dbs so that the flushes of several processes don't
+    all wait for the same write lock, or a store held in memory.
+    """
+    if backend == "sqlite":
+        return RequestsDB(database, sequence_mode, compress_min_len)
+    if backend == "sharded":
+        return ShardedRequestsDB(database, sequence_mode, compress_min_len, nb_shards)
+    if backend == "memory":
+        return MemoryRequestsDB(sequence_mode, compress_min_len)
+    raise ValueError(f"unknown db backend {backend}, expected sqlite, sharded or memory")
+
+def get_top_requests(mode="exact", capacity=10000, k=10):
+    """
+    Return the top of the most frequent requests: exact, or approximated with
+    a fixed number of counters for a very high number of distinct requests.
+    """
+    if mode == "exact":
+        return TopRequests(k)
+    if mode == "sketch":
+        return SketchTopRequests(k, capacity)
+    raise ValueError(f"unknown statistics mode {mode}, expected exact or sketch")
+
+class SequenceResponse:
+    """
+    Encoded body of a sequence reply, along with its gzip compressed version
+    when the body is at least gzip_min_size bytes long. Both are built once,
+    then served as is from the cache.
+
+    A generated sequence is built by from_blocks, straight from the JSON
+    escaped bytes blocks of its generator: the body is the only full size
+    copy, instead of the sequence, its JSON encoding and the encoded body.
+    Its offsets are the ends of the blocks in the escaped sequence, from which
+    prefix slices the response of a shorter sequence of the same rules.
+    """
+    __slots__ = ("body", "gzipped", "offsets")
+
+    # the fastest level, giving most of the size reduction for a fraction of
+    # the time spent by the default level.
+    GZIP_LEVEL = 1
+    # the body around the escaped sequence, as written by json_encode
+    BODY_PREFIX = b'{"sequence": "'
+    BODY_SUFFIX = b'"}'
+
+    def __init__(self, seq, gzip_min_size=1024):
+        self._set_body(json_encode({"sequence": seq}).encode(), gzip_min_size)
+        self.offsets = None
+
+    @classmethod
+    def from_blocks(cls, blocks, gzip_min_size=1024):
+        blocks = list(blocks)
+        response = cls.__new__(cls)
+        response._set_body(b"".join(chain([cls.BODY_PREFIX], blocks, [cls.BODY_SUFFIX])),
+                           gzip_min_size)
+        response.offsets = array("q", accumulate(map(len, blocks)))
+        return response
+
+    def prefix(self, count, gzip_min_size=1024):
+        """
+        Return the response of the count first elements of the sequence,
+        sliced from the body: the complete blocks are found from the offsets,
+        only the commas of the last block are searched. It requires the
+        offsets of a response built by from_blocks.
+        """
+        size = FizzBuzzSeqGenerator.BLOCK_SIZE
+        start = len(self.BODY_PREFIX)
+        # the block i holds the elements up to (i + 1) * size - 1
+        nb_blocks = (count + 1) // size
+        end = self.offsets[nb_blocks - 1] if nb_blocks else 0
+        offsets = self.offsets[:nb_blocks]
+        remaining = count - (nb_blocks * size - 1 if nb_blocks else 0)
+        if remaining > 0:
+            window = self.body[start + end:start + self.offsets[nb_blocks]]
+            # the blocks after the first one start with a comma
+            nb_commas = remaining + (1 if nb_blocks else 0)
+            parts = window.split(b",", nb_commas)
+            end += len(window) - len(parts[-1]) - 1 if len(parts) > nb_commas else len(window)
+            offsets.append(end)
+        response = type(self).__new__(type(self))
+        response._set_body(b"".join([self.BODY_PREFIX, memoryview(self.body)[start:start + end],
+                                     self.BODY_SUFFIX]), gzip_min_size)
+        response.offsets = offsets
+        return response
+
+    def _set_body(self, body, gzip_min_size):
+        self.body = body
+        self.gzipped = None
+        if len(body) >= gzip_min_size:
+            self.gzipped = gzip.compress(body, self.GZIP_LEVEL)
+
+    @property
+    def size(self):
+        size = sys.getsizeof(self.body)
+        if self.gzipped is not None:
+            size += sys.getsizeof(self.gzipped)
+        if self.offsets is not None:
+            size += sys.getsizeof(self.offsets)
+        return size
+
+    def sequence(self):
+        return json_decode(self.body)["sequence"]
+
+def build_response(seqGenerator, gzip_min_size, source=None):
+    """
+    Return the response of the sequence, sliced from the response of a longer
+    sequence of the same rules if a source is given, otherwise generated.
+    """
+    if source is not None:
+        return source.prefix(seqGenerator.limit, gzip_min_size)
+    return SequenceResponse.from_blocks(seqGenerator.json_blocks(), gzip_min_size)
+
+def build_responses(seqGenerators, gzip_min_size, sources=None):
+    sources = sources if sources is not None else [None] * len(seqGenerators)
+    return [build_response(seqGenerator, gzip_min_size, source)
+            for (seqGenerator, source) in zip(seqGenerators, sources)]
+
+def cache_response(cache, prefix_index, seqGenerator, response):
+    """
+    Put the response in the cache, and index it as a prefix source if it can
+    be sliced. Return whether it's cached.
+    """
+    req_id = seqGenerator.req_id()
+    if not cache.put(req_id, response, response.size):
+        return False
+    if prefix_index is not None:
+        if response.offsets is not None:
+            prefix_index.add(seqGenerator.family(), seqGenerator.limit, req_id)
+        else:
+            # the key may still be indexed from a sliceable response evicted
+            # since, replaced by one loaded from the db
+            prefix_index.remove(seqGenerator.family(), seqGenerator.limit, req_id)
+    return True
+
+def load_response(db, req_id, gzip_min_size):
+    """
+    Return the response of a sequence saved in the db, None if it's not saved.
+    """
+    rec = db.get(req_id)
+    if rec is None or not rec[0]:
+        return None
+    return SequenceResponse(rec[0], gzip_min_size)
+
+def load_responses(db, req_ids, gzip_min_size):
+    return [load_response(db, req_id, gzip_min_size) for req_id in req_ids]
+
+def warm_cache(cache, recs, max_limit=1000000, stream_min_limit=100000, gzip_min_size=1024,
+               prefix_index=None):
+    """
+    Put in the cache the responses of the given (request id, sequence) records,
+    the sequences which are None being generated, the last record being the
+    most recently used. The requests already cached, invalid or streamed are
+    skipped. The generated responses are indexed in prefix_index, if given.
+    Return the number of cached responses.
+    """
+    nb_warmed = 0
+    for (req_id, seq) in recs:
+        if req_id in cache:
+            continue
+        try:
+            seqGenerator = FizzBuzzSeqGenerator.from_req_id(req_id, max_limit)
+        except ValueError:
+            continue
+        if seqGenerator.limit >= stream_min_limit:
+            continue
+        if seq:
+            response = SequenceResponse(seq, gzip_min_size)
+        else:
+            response = build_response(seqGenerator, gzip_min_size)
+        if cache_response(cache, prefix_index, seqGenerator, response):
+            nb_warmed += 1
+    return nb_warmed
+
+def write_cache_snapshot(cache, path):
+    """
+    Save the request ids of the cached sequences, from the least to the most
+    recently used: the sequences are generated back from them when the cache
+    is warmed at the next start.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as snapshot:
+        snapshot.write(json_encode({"requests": cache.keys()}))
+    # a snapshot being read is never partially written
+    os.replace(tmp_path, path)
+
+def read_cache_snapshot(path):
+    """
+    Return the request ids saved by write_cache_snapshot, none if there is
+    no valid snapshot.
+    """
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path) as snapshot:
+            req_ids = json_decode(snapshot.read())["requests"]
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        LOGGER.warning("unable to read the cache snapshot %s: %s", path, err)
+        return []
+    return [req_id for req_id in req_ids if isinstance(req_id, str)]
+
+def timed_call(func):
+    """
+    Return the (start time, result, end time) of func(), so that the time an
+    executor task waited can be told apart from the time it ran.
+    """
+    started = time.monotonic()
+    res = func()
+    return (started, res, time.monotonic())
+
+# }}}
+# {{{ Metrics
+
+class ServerMetrics(MetricsRegistry):
+    """
+    Metrics of the server, served by /metrics in the Prometheus text format.
+    The requests only record the latencies and the sizes, the counters kept
+    by the cache, the queue, the writer and the flights are read when the
+    metrics are rendered.
+    """
+
+    def __init__(self, cache, writer=None, flights=None, admission=None, prefix_index=None):
+        super().__init__("fizzbuzz")
+        self.request_duration = self.histogram(
+            "request_duration_seconds", "Time spent serving the requests.", ["handler"])
+        self.response_size = self.histogram(
+            "response_size_bytes", "Size of the reply bodies.", ["handler"], SIZE_BUCKETS)
+        self.executor_wait = self.histogram(
+            "executor_wait_seconds", "Time spent by the tasks waiting for an executor.",
+            ["task"])
+        self.executor_run = self.histogram(
+            "executor_run_seconds", "Time spent by the tasks running in an executor.",
+            ["task"])
+        self.db_lookups = self.counter(
+            "db_lookups_total", "Sequences looked up in the db.", ["result"])
+        self.callback("cache_lookups_total", "Sequences looked up in the cache.",
+                      lambda: {("hit",): cache.hits, ("miss",): cache.misses},
+                      "counter", ["result"])
+        self.callback("cache_evictions_total", "Sequences evicted from the cache.",
+                      lambda: cache.evictions, "counter")
+        self.callback("cache_size_bytes", "Memory used by the cached sequences.",
+                      lambda: cache.size)
+        self.callback("requests_queue_pending", "Distinct requests waiting to be saved.",
+                      lambda: len(REQUESTS_QUEUE))
+        self.callback("requests_queue_requests", "Requests waiting to be saved.",
+                      lambda: REQUESTS_QUEUE.nb_requests)
+        self.callback("requests_queue_lag_seconds",
+                      "Time the oldest request waiting to be saved has been waiting for.",
+                      REQUESTS_QUEUE.lag)
+        self.callback("requests_queue_last_flush_lag_seconds",
+                      "Time the oldest request saved by the last flush had waited for.",
+                      lambda: REQUESTS_QUEUE.last_flush_lag)
+        if flights is not None:
+            self.callback("coalesced_requests_total",
+                          "Requests which waited for a sequence computed for another one.",
+                          lambda: flights.nb_coalesced, "counter")
+        if prefix_index is not None:
+            self.callback("prefix_lookups_total",
+                          "Sequences looked up as the prefix of a longer cached one.",
+                          lambda: {("hit",): prefix_index.hits, ("miss",): prefix_index.misses},
+                          "counter", ["result"])
+        if admission is not None:
+            self.callback("admission_total", "Generations admitted per lane, or rejected.",
+                          lambda: {("fast",): admission.nb_fast,
+                                   ("heavy",): admission.nb_heavy,
+                                   ("rejected",): admission.nb_rejected},
+                          "counter", ["lane"])
+            self.callback("admission_heavy_running", "Heavy generations running.",
+                          lambda: admission.nb_running)
+            self.callback("admission_heavy_waiting", "Heavy generations waiting for their turn.",
+                          lambda: len(admission.waiters))
+        if writer is not None:
+            # recorded from the writer thread only
+            self.flush_duration = self.histogram(
+                "flush_duration_seconds", "Time spent saving a batch of requests.")
+            self.flush_rows = self.histogram(
+                "flush_rows", "Number of requests saved per batch.",
+                buckets=(1, 10, 100, 1000, 10000, 100000))
+            writer.on_write = self.observe_write
+            self.callback("writer_pending_batches", "Batches waiting for the writer.",
+                          lambda: writer.queue.qsize())
+            self.callback("writer_records_total", "Records handled by the writer.",
+                          lambda: {("written",): writer.nb_written,
+                                   ("dropped",): writer.nb_dropped},
+                          "counter", ["result"])
+            self.callback("writer_retrying_records", "Records failed to be saved, being retried.",
+                          lambda: writer.nb_retrying)
+            self.callback("writer_errors_total", "Batches the writer failed to save.",
+                          lambda: writer.nb_errors, "counter")
+
+    def observe_write(self, nb_recs, duration):
+        self.flush_duration.observe(duration)
+        self.flush_rows.observe(nb_recs)
+
+class FizzBuzzApplication(Application):
+    def __init__(self, handlers, metrics, profiler=None, **settings):
+        super().__init__(handlers, **settings)
+        self.metrics = metrics
+        self.profiler = profiler
+
+    def log_request(self, handler):
+        name = type(handler).__name__
+        self.metrics.request_duration.labels(name).observe(handler.request.request_time())
+        self.metrics.response_size.labels(name).observe(getattr(handler, "nb_bytes", 0))
+        if getattr(handler, "profile_path", None) is not None:
+            self.profiler.stop_request()
+            LOGGER.info("request profile written to %s", handler.profile_path)
+        super().log_request(handler)
 
 # }}}
 # {{{ FizzBuzz Handler
@@ -43,6 +471,64 @@ class FizzBuzzHandler(RequestHandler):
     HTTP_BAD_REQ_CODE = 400
     HTTP_STATUS_OK = 200
     HTTP_STATUS_NO_CONTENT = 204
+    HTTP_STATUS_NOT_MODIFIED = 304
+    HTTP_STATUS_SERVICE_UNAVAILABLE = 503
+
+    # header asking for the request to be profiled, when the profiling is enabled
+    PROFILE_HEADER = "X-Fizzbuzz-Profile"
+
+    # bytes of the reply body, for the metrics
+    nb_bytes = 0
+    # path of the profile of the request, if it's profiled
+    profile_path = None
+
+    def __init__(self, application, request, **kwargs):
+        if application.profiler is not None and self.PROFILE_HEADER in request.headers:
+            self.profile_path = application.profiler.start_request()
+        super().__init__(application, request, **kwargs)
+        if self.profile_path is not None:
+            self.set_header(self.PROFILE_HEADER, self.profile_path)
+
+    def write(self, chunk):
+        self.nb_bytes += len(chunk)
+        super().write(chunk)
+
+    async def _run_in_executor(self, executor, task, func):
+        """
+        Run func in the executor, recording the time it waited and ran.
+        """
+        submitted = time.monotonic()
+        (started, res, ended) = await IOLoop.current().run_in_executor(
+            executor, partial(timed_call, func))
+        self.metrics.executor_wait.labels(task).observe(started - submitted)
+        self.metrics.executor_run.labels(task).observe(ended - started)
+        return res
+
+    async def _generate(self, size, func, cost):
+        """
+        Run the generation of size elements of a sequence, cost being their
+        estimated size. Raise AdmissionError if the generation is rejected.
+        It requires the admission, the executors and inline_max_limit of the
+        handler.
+        """
+        # small sequences are generated inline, they would spend more time
+        # in the executor round trip than in the generation itself.
+        if size <= self.inline_max_limit:
+            return func()
+        # Retrieving the sequence may take some time depending on the user
+        # provided to the limit. So run this blocking part asynchronously
+        # for a better handling of simultaneous requests.
+        async with self.admission.admit(cost) as heavy:
+            return await self._run_in_executor(
+                self.executor if heavy else self.fast_executor, "generate", func)
+
+    def _reply_overloaded(self, err):
+        self.error = {
+            "code": self.HTTP_STATUS_SERVICE_UNAVAILABLE,
+            "msg": str(err),
+        }
+        self.set_header("Retry-After", str(self.retry_after))
+        self._reply_error_and_finish()
 
     def _check_content_type(self):
         content_type = self.request.headers.get("Content-Type")
@@ -68,6 +554,10 @@ class FizzBuzzHandler(RequestHandler):
 
     def _reply_error_and_finish(self):
         assert (self.error)
+        # the caching headers of a sequence set before the error only apply
+        # to the sequence, the error must not be cached in its place
+        for header in ["Cache-Control", "Etag", "Vary"]:
+            self.clear_header(header)
         self._set_reply_content_type()
         self.set_status(self.error.get("code"))
         self.finish(json_encode({"error": self.error.get("msg")}))
@@ -82,41 +572,135 @@ class FizzBuzzHandler(RequestHandler):
 # {{{ FizzBuzz Sequence handler
 
 class FizzBuzzSequenceHandler(FizzBuzzHandler):
-    def initialize(self, db=None, queue_max_size=100, **kwargs):
+    """
+    Return the sequence of the request given either as a JSON body to POST, or
+    as the query arguments of GET. A sequence only depends on the request, so
+    the GET replies have a strong ETag derived from the request and can be
+    cached forever by the clients and the proxies.
+
+    The "pattern" format, asked with a format field or the PATTERN_CONTENT_TYPE
+    Accept value, returns the compact form of the sequence given by
+    FizzBuzzSeqGenerator.pattern instead of the sequence.
+
+    The generations are admitted by their estimated size: the small ones run
+    in the fast executor, the heavy ones in the executor, a few at a time.
+    When too many heavy ones wait, the request is rejected with a 503 and a
+    Retry-After, rather than delaying every other request.
+    """
+    ARGS = ["int1", "int2", "limit", "str1", "str2"]
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+    FORMATS = ["sequence", "pattern"]
+    PATTERN_CONTENT_TYPE = "application/vnd.fizzbuzz.pattern+json"
+
+    def initialize(self, db=None, writer=None, cache=None, top_requests=None,
+                   flights=None, queue_max_size=100, max_limit=1000000,
+                   stream_min_limit=100000, stream_chunk_size=65536,
+                   executor=None, inline_max_limit=1000, gzip_min_size=1024,
+                   metrics=None, admission=None, fast_executor=None, retry_after=1,
+                   prefix_index=None, **kwargs):
         self.db = db
+        self.writer = writer
+        self.cache = cache
+        self.prefix_index = prefix_index
+        self.top_requests = top_requests
+        self.flights = flights
         self.queue_max_size = queue_max_size
+        self.executor = executor
+        self.inline_max_limit = inline_max_limit
+        self.admission = admission
+        self.fast_executor = fast_executor
+        self.retry_after = retry_after
+        self.gzip_min_size = gzip_min_size
+        self.metrics = metrics
+        self.response = None
+        self.generated = False
+        self.etags = None
+        self.format = "sequence"
+        self.max_limit = max_limit
+        self.stream_min_limit = stream_min_limit
+        self.stream_chunk_size = stream_chunk_size
         self.error = None
 
     def prepare(self):
-        if not self._check_content_type():
-            return
         self.retrievedArgs = {}
+        if self.request.method == "GET":
+            body = {key: self.get_query_argument(key, None) for key in self.ARGS + ["rules"]}
+            where = "query"
+        else:
+            if not self._check_content_type():
+                return
+            try:
+                body = self.body = json_decode(self.request.body)
+            except:
+                self.error = {
+                    "code": self.HTTP_BAD_REQ_CODE,
+                    "msg": "unable to decode the provided body",
+                }
+                return
+            where = "body"
+
         try:
-            body = json_decode(self.request.body)
-        except:
+            self.retrievedArgs = self._retrieve_args(body, where)
+            self.format = self._retrieve_format(body)
+        except ValueError as err:
             self.error = {
                 "code": self.HTTP_BAD_REQ_CODE,
-                "msg": "unable to decode the provided body",
+                "msg": str(err),
             }
-            return
 
-        for key in ["int1", "int2", "limit", "str1", "str2"]:
+    def _retrieve_format(self, body):
+        if self.request.method == "GET":
+            fmt = self.get_query_argument("format", None)
+        else:
+            fmt = body.get("format")
+        if fmt is None:
+            accept = self.request.headers.get("Accept", "")
+            return "pattern" if self.PATTERN_CONTENT_TYPE in accept else "sequence"
+        if fmt not in self.FORMATS:
+            raise ValueError(f"unknown format {fmt}, expected one of {self.FORMATS}")
+        return fmt
+
+    def _retrieve_args(self, body, where):
+        """
+        Return the stripped request args found in body, raise ValueError if one
+        is missing. A request gives either int1, int2, str1 and str2, or a list
+        of [divisor, string] rules, JSON encoded in a query.
+        """
+        rules = body.get("rules")
+        if rules is not None:
+            if any(body.get(key) is not None for key in self.ARGS if key != "limit"):
+                raise ValueError("rules cannot be given along with int1, int2, str1 and str2")
+            if body.get("limit") is None:
+                raise ValueError(f"limit is missing in the request {where}")
+            if isinstance(rules, str):
+                try:
+                    rules = json_decode(rules)
+                except ValueError:
+                    raise ValueError("rules must be a JSON array of [divisor, string] pairs")
+            return {"limit": str(body["limit"]).strip(), "rules": rules}
+
+        args = {}
+        for key in self.ARGS:
             val = body.get(key)
             if val is None:
-                self.error = {
-                    "code": self.HTTP_BAD_REQ_CODE,
-                    "msg": f"{key} is missing in the request body"
-                }
-                return
-            self.retrievedArgs[key] = str(val).strip()
+                raise ValueError(f"{key} is missing in the request {where}")
+            args[key] = str(val).strip()
+        return args
+
+    async def get(self):
+        await self._reply_sequence(cacheable=True)
 
     async def post(self):
+        await self._reply_sequence()
+
+    async def _reply_sequence(self, cacheable=False):
         if self.error is not None:
             self._reply_error_and_finish()
             return
 
         try:
-            seqGenerator = FizzBuzzSeqGenerator(**self.retrievedArgs)
+            seqGenerator = FizzBuzzSeqGenerator(**self.retrievedArgs,
+                                                maxLimit=self.max_limit)
         except ValueError as err:
             self.error = {
                 "code": self.HTTP_BAD_REQ_CODE,
@@ -125,91 +709,509 @@ class FizzBuzzSequenceHandler(FizzBuzzHandler):
             self._reply_error_and_finish()
             return
 
-        self.req_id = self._get_req_id()
+        self.req_id = seqGenerator.req_id()
+
+        # a client already holding the sequence doesn't need it again, it's
+        # neither looked up nor generated. It's still counted in the
+        # statistics, as a request for the sequence.
+        if cacheable and self._set_cache_headers(seqGenerator):
+            if self.format != "pattern":
+                # the sequence may have been sent gzip compressed, which the
+                # caches must be told as in the full replies
+                self.add_header("Vary", "Accept-Encoding")
+            self.set_status(self.HTTP_STATUS_NOT_MODIFIED)
+            self.finish()
+            LOGGER.info("sequence not modified for: %s", self.retrievedArgs)
+            return
+
+        try:
+            if self.format == "pattern":
+                await self._reply_pattern(seqGenerator)
+                return
 
-        # check in the most queried cache first
-        global MOST_QUERIED
-        self.sequence = MOST_QUERIED.get(self.req_id)
-        if self.sequence:
-            self._reply_success("sequence", self.sequence)
+            # check in the responses cache first
+            self.response = self.cache.get(self.req_id)
+            if self.response is None:
+                # identical requests made meanwhile wait for the same response
+                self.response = await self.flights.run(
+                    self.req_id, partial(self._load, seqGenerator))
+
+            # Big sequences are streamed so that they are never fully held in
+            # memory. They are not saved in the db either.
+            if self.response is None:
+                await self._reply_stream(seqGenerator)
+                return
+        except AdmissionError as err:
+            self._reply_overloaded(err)
             return
 
+        self._reply_response(self.response)
+
+    def _set_cache_headers(self, seqGenerator):
+        """
+        Set the caching headers of the sequence, return True if the client
+        already holds it according to If-None-Match.
+
+        The gzip compressed body and the pattern have their own ETag, since
+        they are different representations of the sequence.
+        """
+        # the equivalent requests share their canonical id, and their bytes
+        digest = hashlib.sha1(seqGenerator.req_id().encode()).hexdigest()
+        if self.format == "pattern":
+            self.etags = {"identity": f'"{digest}-pattern"'}
+        else:
+            self.etags = {"identity": f'"{digest}"', "gzip": f'"{digest}-gzip"'}
+        self.set_header("Cache-Control", self.CACHE_CONTROL)
+        self.set_header("Etag", self.etags["identity"])
+        # the format can be chosen by the Accept header
+        self.add_header("Vary", "Accept")
+
+        none_match = self.request.headers.get("If-None-Match", "")
+        for etag in self.etags.values():
+            if etag in none_match or none_match.strip() == "*":
+                self.set_header("Etag", etag)
+                return True
+        return False
+
+    async def _load(self, seqGenerator):
+        """
+        Return the response of the sequence from the db, sliced from a longer
+        cached one, or generated. Return None for a big sequence which must be
+        streamed.
+        """
+        response = None
         # check if request is on the db just return the retrieved value.
         # make the db interaction asynchroneous.
-        if self.db:
-            self.sequence = await IOLoop.current().run_in_executor(
-                None, partial(self.db.get, self.req_id))
-            self.sequence = self.sequence[0] if self.sequence is not None else None
-            if self.sequence:
-                self._reply_success("sequence", self.sequence)
-                return
+        if self.db and self.db.sequence_mode != "none":
+            response = await self._run_in_executor(
+                None, "db", partial(load_response, self.db, self.req_id, self.gzip_min_size))
+            self.metrics.db_lookups.labels("miss" if response is None else "hit").inc()
 
-        # Retrieving the sequence may take some time depending on the user
-        # provided to the limit. So run this blocking part asynchronously
-        # for a better handling of simultaneous requests.
-        self.sequence = await IOLoop.current().run_in_executor(None, seqGenerator.sequence)
-        self._reply_success("sequence", self.sequence)
+        if response is None:
+            if seqGenerator.limit >= self.stream_min_limit:
+                return None
+            source = self._find_source(seqGenerator)
+            if source is not None:
+                response = await self._slice(
+                    seqGenerator.limit,
+                    partial(build_response, seqGenerator, self.gzip_min_size, source))
+            else:
+                response = await self._generate(
+                    seqGenerator.limit,
+                    partial(build_response, seqGenerator, self.gzip_min_size),
+                    seqGenerator.estimated_size())
+            self.generated = True
+
+        cache_response(self.cache, self.prefix_index, seqGenerator, response)
+        return response
+
+    def _find_source(self, seqGenerator):
+        """
+        Return the cached response of the shortest longer sequence of the same
+        rules, from which the sequence can be sliced, None if there is none.
+        """
+        if self.prefix_index is None:
+            return None
+        found = self.prefix_index.find(seqGenerator.family(), seqGenerator.limit)
+        return found[1] if found is not None else None
+
+    async def _slice(self, size, func):
+        """
+        Run the slicing of size elements from a cached response. It's only a
+        copy of the cached bytes, so it's never held back by the admission,
+        and it runs in the fast executor, whose threads share the cache.
+        """
+        if size <= self.inline_max_limit:
+            return func()
+        return await self._run_in_executor(self.fast_executor, "slice", func)
 
     def on_finish(self):
         if self.error is not None:
             return
 
-        global REQUESTS_QUEUE
-        REQUESTS_QUEUE.append((self.req_id, self.sequence))
-        if self.db and len(REQUESTS_QUEUE) >= self.queue_max_size:
-            flush_queue(self.db)
+        self.top_requests.add(self.req_id)
+        if self.db is None:
+            return
 
-    def _reply_success(self, key, val):
-        super()._reply_success(key, val)
+        # the sequence is saved along with the request which generated it, if
+        # the db saves sequences at all.
+        seq = None
+        if self.generated and self.db.sequence_mode != "none":
+            seq = self.response.sequence()
+
+        REQUESTS_QUEUE.add(self.req_id, seq)
+        if REQUESTS_QUEUE.nb_requests >= self.queue_max_size:
+            flush_queue(self.db, self.writer)
+
+    def _reply_response(self, response):
+        self._set_reply_content_type()
+        self.set_status(self.HTTP_STATUS_OK)
+        body = response.body
+        if response.gzipped is not None:
+            self.add_header("Vary", "Accept-Encoding")
+            if self._accepts_gzip():
+                self.set_header("Content-Encoding", "gzip")
+                if self.etags is not None:
+                    self.set_header("Etag", self.etags["gzip"])
+                body = response.gzipped
+        self.finish(body)
         LOGGER.info(f"successfull sequence generated for: %s", self.retrievedArgs)
 
-    def _get_req_id(self):
-        return (f"{self.retrievedArgs['int1']}_{self.retrievedArgs['int2']}_"
-                f"{self.retrievedArgs['limit']}_{self.retrievedArgs['str1']}_"
-                f"{self.retrievedArgs['str2']}")
+    async def _reply_pattern(self, seqGenerator):
+        period = seqGenerator.pattern_period()
+        pattern = await self._generate(period, seqGenerator.pattern,
+                                       seqGenerator.estimated_size(period))
+        self.set_header("Content-Type", self.PATTERN_CONTENT_TYPE)
+        self.set_status(self.HTTP_STATUS_OK)
+        self.finish(json_encode({"pattern": pattern}))
+        LOGGER.info(f"successfull pattern generated for: %s", self.retrievedArgs)
+
+    def _accepts_gzip(self):
+        for coding in self.request.headers.get("Accept-Encoding", "").split(","):
+            (name, _, params) = coding.partition(";")
+            if name.strip() == "gzip":
+                return params.replace(" ", "") not in ["q=0", "q=0.0", "q=0.00", "q=0.000"]
+        return False
+
+    async def _reply_stream(self, seqGenerator):
+        """
+        Send the sequence by chunks using the chunked transfer encoding, the
+        reply body is the same as the one sent by _reply_response.
+
+        The generation of each chunk is admitted on its own, so that a slow
+        client doesn't hold an admission slot while its chunks are sent. The
+        first one is admitted before the reply is started, so that a rejected
+        stream is answered 503, the next ones wait for their turn.
+        """
+        chunks = seqGenerator.chunks(self.stream_chunk_size, escaped=True)
+        # a chunk is about stream_chunk_size characters
+        cost = min(self.stream_chunk_size, seqGenerator.estimated_size())
+        chunk = await self._next_chunk(chunks, cost)
+        self._set_reply_content_type()
+        self.set_status(self.HTTP_STATUS_OK)
+        self.write(SequenceResponse.BODY_PREFIX)
+        while chunk is not None:
+            self.write(chunk)
+            try:
+                await self.flush()
+            except StreamClosedError:
+                LOGGER.info("connection closed while streaming: %s", self.retrievedArgs)
+                return
+            chunk = await self._next_chunk(chunks, cost, reject=False)
+        self.finish(SequenceResponse.BODY_SUFFIX)
+        LOGGER.info(f"successfull sequence streamed for: %s", self.retrievedArgs)
+
+    async def _next_chunk(self, chunks, cost, reject=True):
+        """
+        Generate the next chunk of a stream, None after the last one. The
+        chunks generator can't be sent to a process executor, it always runs
+        in a thread.
+        """
+        async with self.admission.admit(cost, reject):
+            return await self._run_in_executor(None, "stream", partial(next, chunks, None))
 
 # }}}
-# {{{ FizzBuzz Statistics handler
+# {{{ FizzBuzz Range handler
 
-class FizzBuzzStatisticsHandler(FizzBuzzHandler):
-    def initialize(self, db, stats_cache_life_time=3600*24, **kwargs):
-        self.db = db
-        self.cache_life_time = stats_cache_life_time
+class FizzBuzzRangeHandler(FizzBuzzSequenceHandler):
+    """
+    Return a page of a sequence: the elements [offset, offset + count).
+    Only the requested elements are generated, so the limit can be much
+    bigger than the one of the sequence endpoint. The returned next_offset
+    is the offset of the next page, null after the last one.
+    """
+    SUPPORTED_METHODS = ("POST",)
 
-    async def get(self):
-        now = int(time.time())
-        global STATS_CACHE
-        if STATS_CACHE is not None and STATS_CACHE[0] + self.cache_life_time > now:
-            #cache is still valid just serve it
-            self._reply_success(STATS_CACHE[1])
+    def initialize(self, max_range_limit=10**12, max_range_count=100000, **kwargs):
+        super().initialize(**kwargs)
+        self.max_range_limit = max_range_limit
+        self.max_range_count = max_range_count
+
+    def prepare(self):
+        super().prepare()
+        if self.error is not None:
+            return
+        try:
+            self.offset = int(str(self.body.get("offset", 0)).strip())
+            self.count = int(str(self.body.get("count", self.max_range_count)).strip())
+        except ValueError:
+            self.error = {
+                "code": self.HTTP_BAD_REQ_CODE,
+                "msg": "offset and count must be integers",
+            }
+
+    async def post(self):
+        if self.error is not None:
+            self._reply_error_and_finish()
+            return
+
+        try:
+            seqGenerator = FizzBuzzSeqGenerator(**self.retrievedArgs,
+                                                maxLimit=self.max_range_limit)
+            # an invalid page is rejected before taking an admission slot
+            seqGenerator.validate_slice(self.offset, self.count, self.max_range_count)
+            count = min(self.count, seqGenerator.limit - self.offset)
+            self.sequence = await self._generate(
+                count,
+                partial(seqGenerator.slice, self.offset, self.count,
+                        self.max_range_count),
+                seqGenerator.estimated_size(count))
+        except ValueError as err:
+            self.error = {
+                "code": self.HTTP_BAD_REQ_CODE,
+                "msg": str(err),
+            }
+            self._reply_error_and_finish()
+            return
+        except AdmissionError as err:
+            self._reply_overloaded(err)
+            return
+
+        next_offset = self.offset + self.count
+        self._set_reply_content_type()
+        self.set_status(self.HTTP_STATUS_OK)
+        self.finish(json_encode({
+            "sequence": self.sequence,
+            "offset": self.offset,
+            "next_offset": next_offset if next_offset < seqGenerator.limit else None,
+        }))
+
+    def on_finish(self):
+        # pages are not accounted in the statistics
+        pass
+
+# }}}
+# {{{ FizzBuzz Batch handler
+
+class FizzBuzzBatchHandler(FizzBuzzSequenceHandler):
+    """
+    Return the sequences of an array of requests, in the order of the requests.
+    Each one gets either {"sequence": ...} or {"error": ...}.
+
+    Identical requests are served once, and all the sequences missing from the
+    cache are looked up in the db then generated together, in a single executor
+    submission each. Big sequences, which the sequence endpoint streams, are
+    not served in a batch.
+    """
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, max_batch_size=100, **kwargs):
+        super().initialize(**kwargs)
+        self.max_batch_size = max_batch_size
+        # request id of every valid request, in the request order
+        self.req_ids = []
+        # request id -> response of the sequences generated by this request
+        self.generated_responses = {}
+
+    def prepare(self):
+        if not self._check_content_type():
+            return
+        try:
+            self.body = json_decode(self.request.body)
+        except:
+            self.error = {
+                "code": self.HTTP_BAD_REQ_CODE,
+                "msg": "unable to decode the provided body",
+            }
+            return
+        if not isinstance(self.body, list):
+            self.error = {
+                "code": self.HTTP_BAD_REQ_CODE,
+                "msg": "the request body must be an array of requests",
+            }
+        elif len(self.body) > self.max_batch_size:
+            self.error = {
+                "code": self.HTTP_BAD_REQ_CODE,
+                "msg": (f"a batch cannot hold more than {self.max_batch_size} "
+                        f"requests, got {len(self.body)}"),
+            }
+
+    async def post(self):
+        if self.error is not None:
+            self._reply_error_and_finish()
+            return
+
+        # one reply per request: the response of a request id, or an error
+        replies = []
+        # request id -> generator of the distinct valid requests
+        seqGenerators = {}
+        for body in self.body:
+            try:
+                if not isinstance(body, dict):
+                    raise ValueError("a request must be an object")
+                args = self._retrieve_args(body, "object")
+                seqGenerator = FizzBuzzSeqGenerator(**args, maxLimit=self.max_limit)
+                if seqGenerator.limit >= self.stream_min_limit:
+                    raise ValueError(f"the provided limit ({seqGenerator.limit}) is too "
+                                     "big for a batch, use the sequence endpoint")
+            except ValueError as err:
+                replies.append(json_encode({"error": str(err)}).encode())
+                continue
+            req_id = seqGenerator.req_id()
+            seqGenerators.setdefault(req_id, seqGenerator)
+            self.req_ids.append(req_id)
+            replies.append(req_id)
+
+        try:
+            responses = await self._load_all(seqGenerators)
+        except AdmissionError as err:
+            self._reply_overloaded(err)
             return
+        body = b", ".join(responses[reply] if isinstance(reply, str) else reply
+                          for reply in replies)
+        self._set_reply_content_type()
+        self.set_status(self.HTTP_STATUS_OK)
+        self.finish(b'{"sequences": [' + body + b"]}")
+        LOGGER.info("successfull batch of %d sequences", len(replies))
+
+    async def _load_all(self, seqGenerators):
+        """
+        Return the responses of all the given request ids, from the cache, the
+        db, sliced from longer cached ones, or generated.
+        """
+        responses = {}
+        for req_id in seqGenerators:
+            response = self.cache.get(req_id)
+            if response is not None:
+                responses[req_id] = response
+        missing = [req_id for req_id in seqGenerators if req_id not in responses]
+
+        if missing and self.db and self.db.sequence_mode != "none":
+            loaded = await self._run_in_executor(
+                None, "db", partial(load_responses, self.db, missing, self.gzip_min_size))
+            for (req_id, response) in zip(missing, loaded):
+                self.metrics.db_lookups.labels("miss" if response is None else "hit").inc()
+                if response is not None:
+                    responses[req_id] = response
+                    cache_response(self.cache, self.prefix_index, seqGenerators[req_id],
+                                   response)
+            missing = [req_id for req_id in missing if req_id not in responses]
+
+        sources = {req_id: self._find_source(seqGenerators[req_id]) for req_id in missing}
+        sliced = [req_id for req_id in missing if sources[req_id] is not None]
+        missing = [req_id for req_id in missing if sources[req_id] is None]
 
-        global REQUESTS_QUEUE
-        if REQUESTS_QUEUE:
-            flush_queue(self.db)
+        if sliced:
+            built = await self._slice(
+                sum(seqGenerators[req_id].limit for req_id in sliced),
+                partial(build_responses, [seqGenerators[req_id] for req_id in sliced],
+                        self.gzip_min_size, [sources[req_id] for req_id in sliced]))
+            self._add_built(seqGenerators, responses, zip(sliced, built))
 
-        res = await IOLoop.current().run_in_executor(
-            None, self.db.get_most_hit
-        )
+        if missing:
+            generated = await self._generate(
+                sum(seqGenerators[req_id].limit for req_id in missing),
+                partial(build_responses, [seqGenerators[req_id] for req_id in missing],
+                        self.gzip_min_size),
+                sum(seqGenerators[req_id].estimated_size() for req_id in missing))
+            self._add_built(seqGenerators, responses, zip(missing, generated))
 
-        global MOST_QUERIED
-        MOST_QUERIED.clear()
+        return {req_id: response.body for (req_id, response) in responses.items()}
+
+    def _add_built(self, seqGenerators, responses, built):
+        """
+        Add the (request id, response) built for the batch to its responses
+        and to the cache, they are saved once the batch is replied.
+        """
+        for (req_id, response) in built:
+            responses[req_id] = response
+            cache_response(self.cache, self.prefix_index, seqGenerators[req_id], response)
+            self.generated_responses[req_id] = response
+
+    def on_finish(self):
+        if self.error is not None:
+            return
+
+        # every request is counted, even the duplicated ones
+        for req_id in self.req_ids:
+            self.top_requests.add(req_id)
+        if self.db is None:
+            return
+
+        save_sequences = self.db.sequence_mode != "none"
+        for req_id in self.req_ids:
+            seq = None
+            # the sequences are saved once, along with the request which
+            # generated them.
+            response = self.generated_responses.pop(req_id, None)
+            if save_sequences and response is not None:
+                seq = response.sequence()
+            REQUESTS_QUEUE.add(req_id, seq)
+        if REQUESTS_QUEUE.nb_requests >= self.queue_max_size:
+            flush_queue(self.db, self.writer)
+
+# }}}
+# {{{ FizzBuzz Statistics handler
+
+class FizzBuzzStatisticsHandler(FizzBuzzHandler):
+    """
+    Serve the most frequent requests, counted in memory as they are made so
+    that the statistics are always up to date and never read from the db.
+    """
+
+    def initialize(self, cache, top_requests, max_limit=1000000, gzip_min_size=1024,
+                   metrics=None, prefix_index=None, stream_min_limit=100000,
+                   executor=None, inline_max_limit=1000, admission=None,
+                   fast_executor=None, retry_after=1, **kwargs):
+        self.metrics = metrics
+        self.cache = cache
+        self.prefix_index = prefix_index
+        self.top_requests = top_requests
+        self.max_limit = max_limit
+        self.gzip_min_size = gzip_min_size
+        self.stream_min_limit = stream_min_limit
+        self.executor = executor
+        self.inline_max_limit = inline_max_limit
+        self.admission = admission
+        self.fast_executor = fast_executor
+        self.retry_after = retry_after
+        self.error = None
+
+    async def get(self):
         recs = []
-        if res is not None:
-            for rec in res:
-                (int1, int2, limit, str1, str2) = rec[0].split("_")
-                recs.append({
+        for (req_id, occurrence) in self.top_requests.top():
+            try:
+                seqGenerator = FizzBuzzSeqGenerator.from_req_id(req_id, self.max_limit)
+            except ValueError as err:
+                # e.g. saved before the max limit was lowered
+                LOGGER.warning("invalid request %s skipped from the statistics: %s",
+                               req_id, err)
+                continue
+            # the sequences which would be streamed are not held in a reply
+            seq = None
+            if seqGenerator.limit < self.stream_min_limit:
+                response = self.cache.get(req_id)
+                if response is None:
+                    try:
+                        response = await self._generate(
+                            seqGenerator.limit,
+                            partial(build_response, seqGenerator, self.gzip_min_size),
+                            seqGenerator.estimated_size())
+                    except AdmissionError as err:
+                        self._reply_overloaded(err)
+                        return
+                    cache_response(self.cache, self.prefix_index, seqGenerator, response)
+                seq = response.sequence()
+
+            fields = req_id.split("_")
+            if fields[0] == "r":
+                rec = {
+                    "limit": fields[1],
+                    "rules": [list(rule) for rule in zip(fields[2::2], fields[3::2])],
+                }
+            else:
+                (int1, int2, limit, str1, str2) = fields
+                rec = {
                     "int1": int1,
                     "int2": int2,
                     "limit": limit,
                     "str1": str1,
                     "str2": str2,
-                    "sequence": rec[1],
-                    "nb_occurences": rec[2]
-                })
-                MOST_QUERIED[rec[0]] = rec[1]
+                }
+            rec["sequence"] = seq
+            rec["nb_occurences"] = occurrence
+            recs.append(rec)
 
-        STATS_CACHE = (now, recs)
         self._reply_success(recs)
 
     def _reply_success(self, stats):
@@ -219,17 +1221,105 @@ class FizzBuzzStatisticsHandler(FizzBuzzHandler):
         self.finish(body)
 
 # }}}
+# {{{ Profile handler
+
+class FizzBuzzProfileHandler(FizzBuzzHandler):
+    """
+    Start a profiling session of the server for the given number of seconds,
+    in the "sample" or "cprofile" mode. Only routed when the profiling is
+    enabled.
+    """
+    SUPPORTED_METHODS = ("POST",)
+    HTTP_STATUS_CONFLICT = 409
+
+    def initialize(self, profiler, profile_seconds=30, **kwargs):
+        self.profiler = profiler
+        self.profile_seconds = profile_seconds
+        self.error = None
+
+    def post(self):
+        try:
+            seconds = float(self.get_query_argument("seconds", self.profile_seconds))
+            if seconds <= 0:
+                raise ValueError()
+        except ValueError:
+            self.error = {
+                "code": self.HTTP_BAD_REQ_CODE,
+                "msg": "seconds must be a positive number",
+            }
+            self._reply_error_and_finish()
+            return
+
+        try:
+            path = start_profiling(self.profiler, self.get_query_argument("mode", "sample"),
+                                   seconds)
+        except ValueError as err:
+            self.error = {"code": self.HTTP_BAD_REQ_CODE, "msg": str(err)}
+        except RuntimeError as err:
+            self.error = {"code": self.HTTP_STATUS_CONFLICT, "msg": str(err)}
+        if self.error is not None:
+            self._reply_error_and_finish()
+            return
+        self._reply_success("profile", {"path": path, "seconds": seconds})
+
+# }}}
+# {{{ Metrics handler
+
+class FizzBuzzMetricsHandler(RequestHandler):
+    def initialize(self, metrics, **kwargs):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", self.metrics.CONTENT_TYPE)
+        self.finish(self.metrics.render())
 
-def getApp(db=None, queue_max_size=100, stats_cache_life_time=3600*24):
+# }}}
+
+def getApp(db=None, queue_max_size=100, top_requests=None,
+           max_limit=1000000, stream_min_limit=100000, stream_chunk_size=65536,
+           max_range_limit=10**12, max_range_count=100000, executor=None,
+           inline_max_limit=1000, cache=None, writer=None, flights=None,
+           gzip_min_size=1024, max_batch_size=100, profiler=None, profile_seconds=30,
+           admission=None, fast_executor=None, retry_after=1, prefix_index=None):
+    cache = cache if cache is not None else SequenceCache()
+    flights = flights if flights is not None else SingleFlight()
+    admission = admission if admission is not None else AdmissionControl()
+    prefix_index = prefix_index if prefix_index is not None else PrefixIndex(cache)
+    metrics = ServerMetrics(cache, writer, flights, admission, prefix_index)
     args = {
         "db": db,
+        "writer": writer,
+        "cache": cache,
         "queue_max_size": int(queue_max_size),
-        "stats_cache_life_time": int(stats_cache_life_time),
+        "top_requests": top_requests if top_requests is not None else TopRequests(),
+        "flights": flights,
+        "metrics": metrics,
+        "max_limit": int(max_limit),
+        "stream_min_limit": int(stream_min_limit),
+        "stream_chunk_size": int(stream_chunk_size),
+        "max_range_limit": int(max_range_limit),
+        "max_range_count": int(max_range_count),
+        "executor": executor,
+        "inline_max_limit": int(inline_max_limit),
+        "gzip_min_size": int(gzip_min_size),
+        "max_batch_size": int(max_batch_size),
+        "profiler": profiler,
+        "profile_seconds": float(profile_seconds),
+        "admission": admission,
+        "fast_executor": fast_executor,
+        "retry_after": int(retry_after),
+        "prefix_index": prefix_index,
     }
-    return Application([
+    handlers = [
         (r"/fizzbuzz/sequence", FizzBuzzSequenceHandler, args),
+        (r"/fizzbuzz/sequence/range", FizzBuzzRangeHandler, args),
+        (r"/fizzbuzz/sequences", FizzBuzzBatchHandler, args),
         (r"/fizzbuzz/statistics", FizzBuzzStatisticsHandler, args),
-    ])
+        (r"/metrics", FizzBuzzMetricsHandler, args),
+    ]
+    if profiler is not None:
+        handlers.append((r"/admin/profile", FizzBuzzProfileHandler, args))
+    return FizzBuzzApplication(handlers, metrics, profiler)
 
 def startServer():
     global IS_SERVER_STARTED
@@ -237,22 +1327,132 @@ def startServer():
         return
 
     database = os.getenv("FIZZBUZZ_SERVER_DB_NAME", ".fizzbuzz.db")
-    req_db = RequestsDB(database)
+    sequence_mode = os.getenv("FIZZBUZZ_DB_SEQUENCE_MODE", "none")
+    compress_min_len = os.getenv("FIZZBUZZ_DB_COMPRESS_MIN_LEN", "4096")
+    db_backend = os.getenv("FIZZBUZZ_DB_BACKEND", "sqlite")
+    db_shards = os.getenv("FIZZBUZZ_DB_SHARDS", "4")
+    open_db = partial(get_requests_db, db_backend, database, sequence_mode, compress_min_len,
+                      db_shards)
+    port = os.getenv("FIZZBUZZ_SERVER_PORT", "8888")
+    sockets = bind_sockets(int(port))
+    # the profiling is disabled unless its output directory is set
+    profile_dir = os.getenv("FIZZBUZZ_PROFILE_DIR")
+    nb_processes = int(os.getenv("FIZZBUZZ_PROCESSES", "1"))
+    worker = None
+    if nb_processes > 1:
+        if db_backend == "memory":
+            raise ValueError("the memory db cannot be shared by several processes")
+        # the db is created or migrated once, before the processes open it
+        open_db().close()
+        signals = [signal.SIGTERM, signal.SIGINT] + ([signal.SIGUSR1] if profile_dir else [])
+        worker = fork_workers(nb_processes, signals)
 
-    stats_cache_life_time = os.getenv("FIZZBUZZ_STATS_CACHE_LIFE_TIME", 3600*24)
+    req_db = open_db()
+    # the writer saves the requests with its own connection, the memory db is
+    # shared
+    writer = RequestsWriter(req_db if db_backend == "memory" else open_db(),
+                            os.getenv("FIZZBUZZ_WRITER_MAX_PENDING", "100"),
+                            os.getenv("FIZZBUZZ_WRITER_POLICY", "block"))
+    writer.start()
+    writer_drain_timeout = float(os.getenv("FIZZBUZZ_WRITER_DRAIN_TIMEOUT", "10"))
+
+    # count the requests in memory from the ones saved in the db
+    stats_mode = os.getenv("FIZZBUZZ_STATS_MODE", "exact")
+    stats_capacity = int(os.getenv("FIZZBUZZ_STATS_SKETCH_CAPACITY", "10000"))
+    stats_max_rows = stats_capacity if stats_mode == "sketch" else None
+    top_requests = get_top_requests(stats_mode, stats_capacity)
+    top_requests.seed(req_db.get_counts(stats_max_rows))
     queue_max_size = os.getenv("FIZZBUZZ_QUEUE_MAX_SIZE", "100")
-    port = os.getenv("FIZZBUZZ_SERVER_PORT", "8888")
-    app = getApp(req_db, queue_max_size, stats_cache_life_time)
-    app.listen(int(port))
+    max_limit = os.getenv("FIZZBUZZ_MAX_LIMIT", "1000000")
+    stream_min_limit = os.getenv("FIZZBUZZ_STREAM_MIN_LIMIT", "100000")
+    stream_chunk_size = os.getenv("FIZZBUZZ_STREAM_CHUNK_SIZE", "65536")
+    max_range_limit = os.getenv("FIZZBUZZ_MAX_RANGE_LIMIT", str(10**12))
+    max_range_count = os.getenv("FIZZBUZZ_MAX_RANGE_COUNT", "100000")
+    executor = get_executor(os.getenv("FIZZBUZZ_EXECUTOR", "thread"),
+                            os.getenv("FIZZBUZZ_WORKERS"))
+    inline_max_limit = os.getenv("FIZZBUZZ_INLINE_MAX_LIMIT", "1000")
+    cache = SequenceCache(os.getenv("FIZZBUZZ_CACHE_MAX_BYTES", 64*1024*1024))
+    gzip_min_size = os.getenv("FIZZBUZZ_GZIP_MIN_SIZE", "1024")
+    max_batch_size = os.getenv("FIZZBUZZ_MAX_BATCH_SIZE", "100")
+    profiler = Profiler(profile_dir) if profile_dir else None
+    profile_seconds = float(os.getenv("FIZZBUZZ_PROFILE_SECONDS", "30"))
+    admission = AdmissionControl(os.getenv("FIZZBUZZ_HEAVY_MIN_SIZE", "100000"),
+                                 os.getenv("FIZZBUZZ_MAX_HEAVY", "2"),
+                                 os.getenv("FIZZBUZZ_MAX_HEAVY_WAITING", "16"))
+    fast_executor = ThreadPoolExecutor(int(os.getenv("FIZZBUZZ_FAST_WORKERS", "2")))
+    retry_after = os.getenv("FIZZBUZZ_RETRY_AFTER", "1")
+    prefix_index = PrefixIndex(cache)
+
+    # warm the cache before serving, with the most hit requests then the ones
+    # cached when the server was stopped
+    warm_cache_size = int(os.getenv("FIZZBUZZ_WARM_CACHE_SIZE", "100"))
+    cache_snapshot = os.getenv("FIZZBUZZ_CACHE_SNAPSHOT")
+    if cache_snapshot and worker is not None:
+        # each process has its own cache, "cache.json" is split into
+        # "cache.0.json", "cache.1.json"...
+        (root, ext) = os.path.splitext(cache_snapshot)
+        cache_snapshot = f"{root}.{worker}{ext}"
+    recs = []
+    if warm_cache_size > 0:
+        recs.extend((req_id, seq) for (req_id, seq, _)
+                    in reversed(req_db.get_most_hit(warm_cache_size)))
+    if cache_snapshot:
+        recs.extend((req_id, None) for req_id in read_cache_snapshot(cache_snapshot))
+    if recs:
+        started = time.monotonic()
+        nb_warmed = warm_cache(cache, recs, int(max_limit), int(stream_min_limit),
+                               int(gzip_min_size), prefix_index)
+        LOGGER.info("cache warmed with %d sequences in %.3fs",
+                    nb_warmed, time.monotonic() - started)
+
+    app = getApp(req_db, queue_max_size, top_requests,
+                 max_limit, stream_min_limit, stream_chunk_size,
+                 max_range_limit, max_range_count, executor, inline_max_limit,
+                 cache, writer, None, gzip_min_size, max_batch_size,
+                 profiler, profile_seconds, admission, fast_executor, retry_after,
+                 prefix_index)
+    HTTPServer(app).add_sockets(sockets)
+    # save the requests periodically, even when the queue doesn't fill up
+    flush_interval = float(os.getenv("FIZZBUZZ_FLUSH_INTERVAL", "10"))
+    if nb_processes > 1:
+        # the statistics also count the requests saved by the other processes
+        PeriodicCallback(partial(sync_top_requests, req_db, writer, top_requests,
+                                 stats_max_rows), flush_interval * 1000).start()
+    else:
+        PeriodicCallback(partial(flush_queue, req_db, writer), flush_interval * 1000).start()
     LOGGER.info("server started")
 
     def signal_handler(signum, frame=None):
-        flush_queue(req_db)
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(sig, signal.SIG_IGN)
+        flush_queue(req_db, writer, wait=True)
+        if cache_snapshot:
+            try:
+                write_cache_snapshot(cache, cache_snapshot)
+            except OSError as err:
+                LOGGER.warning("unable to write the cache snapshot %s: %s", cache_snapshot, err)
+        if not writer.stop(writer_drain_timeout):
+            LOGGER.warning("requests not saved after %ss: %s",
+                           writer_drain_timeout, writer.stats())
+        executor.shutdown(wait=False)
+        fast_executor.shutdown(wait=False)
         stopServer()
         sys.exit(0)
 
     for sig in [signal.SIGTERM, signal.SIGINT]:
         signal.signal(sig, signal_handler)
+
+    if profiler is not None:
+        def profile_signal_handler(signum, frame=None):
+            IOLoop.current().add_callback(start_profiling_quietly)
+
+        def start_profiling_quietly():
+            try:
+                start_profiling(profiler, "sample", profile_seconds)
+            except RuntimeError as err:
+                LOGGER.warning("unable to start profiling: %s", err)
+
+        signal.signal(signal.SIGUSR1, profile_signal_handler)
     IS_SERVER_STARTED = True
     IOLoop.current().start()
 
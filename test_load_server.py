@@ -1,20 +1,47 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
+
 from tornado import testing, gen
 from tornado.escape import json_encode, json_decode
 
+from lib.admission import AdmissionControl
+from lib.cache import SequenceCache
 from lib.db import RequestsDB
+from lib.singleflight import SingleFlight
 from server import getApp
 
+class CountingExecutor(ThreadPoolExecutor):
+    """
+    Executor counting the submitted tasks.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.nb_submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.nb_submitted += 1
+        return super().submit(*args, **kwargs)
+
 class TestLoadFizzBuzzServer(testing.AsyncHTTPTestCase):
     HTTP_STATUS_OK = 200
 
     def get_app(self):
         self.db = RequestsDB(database=".testload.db")
-        return getApp(self.db)
+        self.executor = CountingExecutor()
+        self.cache = SequenceCache()
+        self.flights = SingleFlight()
+        self.admission = AdmissionControl(max_heavy=1, max_waiting=2)
+        return getApp(self.db, executor=self.executor, cache=self.cache, flights=self.flights,
+                      admission=self.admission)
 
-    async def load_server(self, load, limit=100):
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+
+    async def load_server(self, load, limit=100, raise_error=True, int2=5):
         results = await gen.multi([
             self.http_client.fetch(
                 self.get_url('/fizzbuzz/sequence'),
@@ -22,13 +49,14 @@ class TestLoadFizzBuzzServer(testing.AsyncHTTPTestCase):
                 headers={"Content-Type": "application/json"},
                 body=json_encode({
                     "int1": 3,
-                    "int2": 5,
+                    "int2": int2,
                     "limit": limit,
                     "str1": "fizz",
                     "str2": "buzz",
                 }),
                 connect_timeout=10,
                 request_timeout=10,
+                raise_error=raise_error,
             ) for _ in range(load)
         ])
         return results
@@ -61,5 +89,42 @@ class TestLoadFizzBuzzServer(testing.AsyncHTTPTestCase):
         for idx, stat in enumerate(stats):
             self.assertEqual(stat.get("nb_occurences"), occs[idx])
 
+    @testing.gen_test
+    async def test_coalesced_req(self):
+        self.db.clear()
+        load = 100
+        results = await self.load_server(load, limit=50000)
+        for res in results:
+            self.assertEqual(res.code, self.HTTP_STATUS_OK)
+
+        # the sequence is generated once, the other requests wait for it or
+        # find it in the cache
+        self.assertEqual(self.executor.nb_submitted, 1)
+        self.assertEqual(self.flights.nb_started, 1)
+        self.assertEqual(self.flights.nb_coalesced + self.cache.hits, load - 1)
+
+    @testing.gen_test(timeout=30)
+    async def test_heavy_req(self):
+        self.db.clear()
+        # distinct heavy requests, which are neither cached nor coalesced
+        heavy = gen.multi([self.load_server(1, limit, raise_error=False)
+                           for limit in range(90000, 90010)])
+        # of other rules, so that they are not sliced from the heavy ones
+        small = gen.multi([self.load_server(10, limit, int2=7) for limit in [20, 5000]])
+        (heavy, small) = await gen.multi([heavy, small])
+
+        # the small requests are served whatever the load of heavy ones
+        for res in sum(small, []):
+            self.assertEqual(res.code, self.HTTP_STATUS_OK)
+        # one heavy request runs and two wait, the others are rejected
+        codes = [res.code for res in sum(heavy, [])]
+        self.assertEqual(codes.count(self.HTTP_STATUS_OK), 3)
+        self.assertEqual(codes.count(503), 7)
+        for res in sum(heavy, []):
+            if res.code == 503:
+                self.assertEqual(res.headers.get("Retry-After"), "1")
+        self.assertEqual(self.admission.stats(), {
+            "running": 0, "waiting": 0, "fast": 1, "heavy": 3, "rejected": 7})
+
 if __name__ == "__main__":
     testing.main()
@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from tornado import testing
-from tornado.escape import json_encode, json_decode
+import gzip
+import os
+import shutil
+import tempfile
 
-from lib.db import RequestsDB
-from server import getApp
+from tornado import gen, testing
+from tornado.escape import json_encode, json_decode, url_escape
+
+from lib.admission import AdmissionControl
+from lib.cache import SequenceCache
+from lib.db import MemoryRequestsDB, RequestsDB
+from lib.fizzbuzz import FizzBuzzSeqGenerator, expand_pattern
+from lib.profiler import Profiler
+from lib.topk import TopRequests
+from lib.writer import RequestsWriter
+import server
+from server import getApp, get_executor, get_requests_db
 
 class TestFizzBuzzServer(testing.AsyncHTTPTestCase):
     HTTP_STATUS_OK = 200
@@ -14,7 +26,9 @@ class TestFizzBuzzServer(testing.AsyncHTTPTestCase):
 
     def get_app(self):
         self.db = RequestsDB(database=".test.db")
-        return getApp(self.db)
+        self.cache = SequenceCache()
+        self.top_requests = TopRequests()
+        return getApp(self.db, cache=self.cache, top_requests=self.top_requests)
 
     def test_empty_body(self):
         resp = self.fetch(
@@ -41,6 +55,108 @@ class TestFizzBuzzServer(testing.AsyncHTTPTestCase):
         self.assertEqual(res, want)
         self.db.clear()
 
+    def test_warm_cache(self):
+        seq = FizzBuzzSeqGenerator(2, 3, 6, "a", "b").sequence()
+        recs = [("2_3_6_a_b", seq), ("3_5_20_fizz_buzz", None), ("invalid", None),
+                ("3_5_200000_fizz_buzz", None)]
+        # the invalid and streamed requests are skipped
+        self.assertEqual(server.warm_cache(self.cache, recs), 2)
+        self.assertEqual(self.cache.keys(), ["2_3_6_a_b", "3_5_20_fizz_buzz"])
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "snapshot.json")
+            self.assertEqual(server.read_cache_snapshot(path), [])
+            server.write_cache_snapshot(self.cache, path)
+            self.assertEqual(server.read_cache_snapshot(path), self.cache.keys())
+            with open(path, "w") as snapshot:
+                snapshot.write("invalid")
+            self.assertEqual(server.read_cache_snapshot(path), [])
+        finally:
+            shutil.rmtree(directory)
+
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 0)
+        self.db.clear()
+
+    def test_cached_request(self):
+        for _ in range(2):
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                body=json_encode({"int1": 3, "int2": 5, "limit": 20, "str1": "fizz", "str2": "buzz"}),
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+            res = json_decode(resp.body).get("sequence")
+            want = "1,2,fizz,4,buzz,fizz,7,8,fizz,buzz,11,fizz,13,14,fizzbuzz,16,17,fizz,19,buzz"
+            self.assertEqual(res, want)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertIn("3_5_20_fizz_buzz", self.cache)
+        self.db.clear()
+
+    def test_prefix_response(self):
+        for (int1, int2, str1, str2) in [(3, 5, "fizz", "buzz"), (2, 7, 'a"/\u00e9', "")]:
+            for source_limit in [1000, 2500, 3000]:
+                source = server.build_response(
+                    FizzBuzzSeqGenerator(int1, int2, source_limit, str1, str2), 1024)
+                for limit in [7, 998, 999, 1000, 1001, 1999, 2000, 2001, source_limit - 1]:
+                    if limit >= source_limit:
+                        continue
+                    want = server.build_response(
+                        FizzBuzzSeqGenerator(int1, int2, limit, str1, str2), 1024)
+                    res = source.prefix(limit, 1024)
+                    self.assertEqual(res.body, want.body)
+                    self.assertEqual(res.offsets, want.offsets)
+                    self.assertEqual(res.gzipped is None, want.gzipped is None)
+
+    def test_prefix_request(self):
+        url = "/fizzbuzz/sequence?int1=3&int2=5&limit={}&str1=fizz&str2=buzz"
+        for limit in [3000, 999, 1001, 5000, 2999]:
+            resp = self.fetch(url.format(limit))
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+            want = FizzBuzzSeqGenerator(3, 5, limit, "fizz", "buzz").sequence()
+            self.assertEqual(json_decode(resp.body).get("sequence"), want)
+        self.assertIn("3_5_999_fizz_buzz", self.cache)
+        # an equivalent request shares the cached sequence
+        resp = self.fetch("/fizzbuzz/sequence?int1=03&int2=5&limit=999&str1=fizz&str2=buzz")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertEqual(self.cache.misses, 5)
+
+        metrics = self.fetch("/metrics").body.decode().splitlines()
+        for line in [
+                'fizzbuzz_prefix_lookups_total{result="hit"} 3',
+                'fizzbuzz_prefix_lookups_total{result="miss"} 2',
+                'fizzbuzz_executor_run_seconds_count{task="slice"} 2',
+                'fizzbuzz_executor_run_seconds_count{task="generate"} 2']:
+            self.assertIn(line, metrics)
+        self.db.clear()
+
+    def test_gzipped_request(self):
+        body = json_encode({"int1": 3, "int2": 5, "limit": 1000, "str1": "fizz", "str2": "buzz"})
+        want = FizzBuzzSeqGenerator(3, 5, 1000, "fizz", "buzz").sequence()
+        for encoding in ["gzip", "identity"]:
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers={"Content-Type": "application/json", "Accept-Encoding": encoding},
+                body=body,
+                decompress_response=False,
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+            self.assertEqual(resp.headers.get("Vary"), "Accept-Encoding")
+            if encoding == "gzip":
+                self.assertEqual(resp.headers.get("Content-Encoding"), "gzip")
+                res = json_decode(gzip.decompress(resp.body)).get("sequence")
+            else:
+                self.assertNotIn("Content-Encoding", resp.headers)
+                res = json_decode(resp.body).get("sequence")
+            self.assertEqual(res, want)
+        self.db.clear()
+
     def test_huge_request(self):
         resp = self.fetch(
             "/fizzbuzz/sequence",
@@ -51,6 +167,274 @@ class TestFizzBuzzServer(testing.AsyncHTTPTestCase):
         self.assertEqual(resp.code, self.HTTP_STATUS_OK)
         self.db.clear()
 
+    def test_streamed_request(self):
+        resp = self.fetch(
+            "/fizzbuzz/sequence",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode({"int1": 3, "int2": 5, "limit": 200000, "str1": "fi</zz", "str2": "b\u00e9\\"}),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertEqual(resp.headers.get("Transfer-Encoding"), "chunked")
+        res = json_decode(resp.body).get("sequence")
+        want = FizzBuzzSeqGenerator(3, 5, 200000, "fi</zz", "b\u00e9\\").sequence()
+        self.assertEqual(res, want)
+        # each chunk is admitted on its own, as a cheap generation
+        metrics = self.fetch("/metrics").body.decode().splitlines()
+        self.assertIn('fizzbuzz_admission_total{lane="heavy"} 0', metrics)
+        self.assertIn('fizzbuzz_admission_heavy_running 0', metrics)
+        self.db.clear()
+
+    def test_get_request(self):
+        query = "int1=3&int2=5&limit=20&str1=fizz&str2=buzz"
+        resp = self.fetch(f"/fizzbuzz/sequence?{query}")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        res = json_decode(resp.body).get("sequence")
+        want = "1,2,fizz,4,buzz,fizz,7,8,fizz,buzz,11,fizz,13,14,fizzbuzz,16,17,fizz,19,buzz"
+        self.assertEqual(res, want)
+        self.assertIn("max-age", resp.headers.get("Cache-Control"))
+        etag = resp.headers.get("Etag")
+
+        # the ETag only depends on the canonical request
+        for equivalent in ["int1=03&int2=5", "int1=-3&int2=5"]:
+            resp = self.fetch(f"/fizzbuzz/sequence?{equivalent}&limit=20&str1=fizz&str2=buzz")
+            self.assertEqual(resp.headers.get("Etag"), etag)
+
+        # the sequence isn't even looked up in the cache
+        lookups = self.cache.misses + self.cache.hits
+        resp = self.fetch(f"/fizzbuzz/sequence?{query}", headers={"If-None-Match": etag})
+        self.assertEqual(resp.code, 304)
+        self.assertEqual(resp.body, b"")
+        self.assertEqual(self.cache.misses + self.cache.hits, lookups)
+        self.assertIn("Accept-Encoding", resp.headers.get("Vary"))
+        # but it's counted in the statistics
+        self.assertEqual(self.top_requests.top(), [("3_5_20_fizz_buzz", 4)])
+
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz")
+        self.assertEqual(resp.code, self.HTTP_STATUS_BAD_REQUEST)
+        res = json_decode(resp.body).get("error")
+        self.assertEqual(res, "str2 is missing in the request query")
+        self.db.clear()
+
+    def test_batch_request(self):
+        reqs = [
+            {"int1": 3, "int2": 5, "limit": 20, "str1": "fizz", "str2": "buzz"},
+            {"int1": 3, "int2": 5, "limit": 20, "str1": "fizz"},
+            {"int1": 2, "int2": 3, "limit": 6, "str1": "a", "str2": "b"},
+            {"int1": 3, "int2": 5, "limit": 20, "str1": "fizz", "str2": "buzz"},
+            {"int1": 3, "int2": 5, "limit": 1000000, "str1": "fizz", "str2": "buzz"},
+        ]
+        resp = self.fetch(
+            "/fizzbuzz/sequences",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode(reqs),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        res = json_decode(resp.body).get("sequences")
+        want = "1,2,fizz,4,buzz,fizz,7,8,fizz,buzz,11,fizz,13,14,fizzbuzz,16,17,fizz,19,buzz"
+        self.assertEqual(len(res), 5)
+        self.assertEqual(res[0], {"sequence": want})
+        self.assertEqual(res[1], {"error": "str2 is missing in the request object"})
+        self.assertEqual(res[2], {"sequence": "1,a,b,a,5,ab"})
+        self.assertEqual(res[3], {"sequence": want})
+        self.assertIn("too big for a batch", res[4].get("error"))
+        # the duplicated request is looked up once
+        self.assertEqual(self.cache.misses, 2)
+
+        resp = self.fetch("/fizzbuzz/statistics")
+        stats = {stat["str1"]: stat["nb_occurences"] for stat in json_decode(resp.body).get("stats")}
+        self.assertEqual(stats, {"fizz": 2, "a": 1})
+        self.db.clear()
+
+    def test_statistics(self):
+        # saved with a bigger max limit, a streamed sequence, a regular one
+        self.top_requests.add("3_5_2000000_fizz_buzz", 3)
+        self.top_requests.add("3_5_200000_fizz_buzz", 2)
+        self.top_requests.add("3_5_20_fizz_buzz", 1)
+        resp = self.fetch("/fizzbuzz/statistics")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        stats = json_decode(resp.body).get("stats")
+        self.assertEqual([(stat["limit"], stat["nb_occurences"]) for stat in stats],
+                         [("200000", 2), ("20", 1)])
+        self.assertIsNone(stats[0]["sequence"])
+        self.assertEqual(stats[1]["sequence"],
+                         FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz").sequence())
+        self.assertNotIn("3_5_200000_fizz_buzz", self.cache)
+
+    def test_invalid_batch_request(self):
+        resp = self.fetch(
+            "/fizzbuzz/sequences",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode({"int1": 3}),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_BAD_REQUEST)
+        res = json_decode(resp.body).get("error")
+        self.assertEqual(res, "the request body must be an array of requests")
+
+    def test_metrics(self):
+        for limit in [20, 20, 2000]:
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                body=json_encode({"int1": 3, "int2": 5, "limit": limit, "str1": "fizz", "str2": "buzz"}),
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+
+        resp = self.fetch("/metrics")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertTrue(resp.headers.get("Content-Type").startswith("text/plain"))
+        metrics = resp.body.decode().splitlines()
+        for line in [
+                'fizzbuzz_request_duration_seconds_count{handler="FizzBuzzSequenceHandler"} 3',
+                'fizzbuzz_response_size_bytes_count{handler="FizzBuzzSequenceHandler"} 3',
+                'fizzbuzz_executor_run_seconds_count{task="generate"} 1',
+                'fizzbuzz_executor_wait_seconds_count{task="generate"} 1',
+                'fizzbuzz_cache_lookups_total{result="hit"} 1',
+                'fizzbuzz_cache_lookups_total{result="miss"} 2']:
+            self.assertIn(line, metrics)
+        self.db.clear()
+
+    def test_profiling_disabled(self):
+        resp = self.fetch("/admin/profile", method="POST", body="")
+        self.assertEqual(resp.code, 404)
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz",
+                          headers={"X-Fizzbuzz-Profile": "1"})
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertNotIn("X-Fizzbuzz-Profile", resp.headers)
+        self.db.clear()
+
+    def test_pattern_request(self):
+        seqGenerator = FizzBuzzSeqGenerator(3, 5, 1000000, "fizz", "buzz")
+        args = {"int1": 3, "int2": 5, "limit": 1000000, "str1": "fizz", "str2": "buzz"}
+        for (body, headers) in [
+                (dict(args, format="pattern"), {}),
+                (args, {"Accept": "application/vnd.fizzbuzz.pattern+json"})]:
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers=dict(headers, **{"Content-Type": "application/json"}),
+                body=json_encode(body),
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+            self.assertLess(len(resp.body), 1000)
+            pattern = json_decode(resp.body).get("pattern")
+            self.assertEqual(pattern, seqGenerator.pattern())
+
+        self.assertEqual(expand_pattern(pattern), seqGenerator.sequence())
+
+        # the pattern has its own ETag
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz")
+        etag = resp.headers.get("Etag")
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz"
+                          "&format=pattern", headers={"If-None-Match": etag})
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertNotEqual(resp.headers.get("Etag"), etag)
+        self.assertIn("Accept", resp.headers.get("Vary"))
+
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz"
+                          "&format=invalid")
+        self.assertEqual(resp.code, self.HTTP_STATUS_BAD_REQUEST)
+        self.db.clear()
+
+    def test_rules_request(self):
+        rules = [[3, "fizz"], [5, "buzz"], [7, "bazz"]]
+        want = ("1,2,fizz,4,buzz,fizz,bazz,8,fizz,buzz,11,"
+                "fizz,13,bazz,fizzbuzz,16,17,fizz,19,buzz,fizzbazz")
+        resp = self.fetch(
+            "/fizzbuzz/sequence",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode({"limit": 21, "rules": rules}),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertEqual(json_decode(resp.body).get("sequence"), want)
+        self.assertIn("r_21_3_fizz_5_buzz_7_bazz", self.cache)
+
+        resp = self.fetch(f"/fizzbuzz/sequence?limit=21&rules={url_escape(json_encode(rules))}")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertEqual(json_decode(resp.body).get("sequence"), want)
+
+        # two rules are the original request
+        resp = self.fetch(
+            "/fizzbuzz/sequence",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode({"limit": 20, "rules": rules[:2]}),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.assertIn("3_5_20_fizz_buzz", self.cache)
+
+        resp = self.fetch("/fizzbuzz/statistics", method="GET")
+        stats = json_decode(resp.body).get("stats")
+        self.assertIn({"limit": "21", "rules": [["3", "fizz"], ["5", "buzz"], ["7", "bazz"]],
+                       "sequence": want, "nb_occurences": 2}, stats)
+
+        for (body, error) in [
+                ({"limit": 21, "rules": rules, "int1": 3}, "rules cannot be given along"),
+                ({"rules": rules}, "limit is missing in the request body"),
+                ({"limit": 21, "rules": [[3]]}, "rules must be a non empty list"),
+                ({"limit": 10, "rules": [[3.9, "fizz"], [True, "x"]]},
+                 "the divisors of the rules must be integers")]:
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                body=json_encode(body),
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_BAD_REQUEST)
+            self.assertIn(error, json_decode(resp.body).get("error"))
+
+        resp = self.fetch("/fizzbuzz/sequence?limit=21&rules=invalid")
+        self.assertEqual(resp.code, self.HTTP_STATUS_BAD_REQUEST)
+        self.db.clear()
+
+    def test_range_request(self):
+        body = {"int1": 3, "int2": 5, "limit": 10**12, "str1": "fizz", "str2": "buzz"}
+        resp = self.fetch(
+            "/fizzbuzz/sequence/range",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode(dict(body, offset=10**12 - 5, count=3)),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        res = json_decode(resp.body)
+        want = {
+            "sequence": "fizz,999999999997,999999999998",
+            "offset": 10**12 - 5,
+            "next_offset": 10**12 - 2,
+        }
+        self.assertEqual(res, want)
+
+        resp = self.fetch(
+            "/fizzbuzz/sequence/range",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode(dict(body, offset=res["next_offset"], count=3)),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        res = json_decode(resp.body)
+        self.assertEqual(res.get("sequence"), "fizz,buzz")
+        self.assertEqual(res.get("next_offset"), None)
+
+    def test_too_big_range_count(self):
+        resp = self.fetch(
+            "/fizzbuzz/sequence/range",
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json_encode({"int1": 3, "int2": 5, "limit": 10**7, "str1": "fizz",
+                              "str2": "buzz", "count": 10**6}),
+        )
+        self.assertEqual(resp.code, self.HTTP_STATUS_BAD_REQUEST)
+        res = json_decode(resp.body).get("error")
+        want = "count 1000000 cannot be bigger that 100000"
+        self.assertEqual(res, want)
+        # the page is rejected before its admission
+        metrics = self.fetch("/metrics").body.decode().splitlines()
+        self.assertIn('fizzbuzz_admission_total{lane="heavy"} 0', metrics)
+
     def test_too_big_limit_request(self):
         limit = 10000000
         resp = self.fetch(
@@ -104,9 +488,221 @@ class TestFizzBuzzServer(testing.AsyncHTTPTestCase):
     def test_unsupported_method(self):
         resp = self.fetch(
             "/fizzbuzz/sequence",
-            method="GET",
+            method="DELETE",
         )
         self.assertEqual(resp.code, self.HTTP_STATUS_METHOD_NO_ALLOWED)
 
+class TestFizzBuzzServerProcessExecutor(testing.AsyncHTTPTestCase):
+    HTTP_STATUS_OK = 200
+
+    def get_app(self):
+        self.db = RequestsDB(database=".test.db")
+        self.executor = get_executor("process", 2)
+        return getApp(self.db, executor=self.executor)
+
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+
+    def test_succcessfull_req(self):
+        for limit in [20, 50000]:
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                body=json_encode({"int1": 3, "int2": 5, "limit": limit, "str1": "fizz", "str2": "buzz"}),
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+            res = json_decode(resp.body).get("sequence")
+            want = FizzBuzzSeqGenerator(3, 5, limit, "fizz", "buzz").sequence()
+            self.assertEqual(res, want)
+        self.db.clear()
+
+    def test_unknown_executor(self):
+        with self.assertRaisesRegex(ValueError, "unknown executor"):
+            get_executor("invalid")
+
+class TestFizzBuzzServerWriter(testing.AsyncHTTPTestCase):
+    HTTP_STATUS_OK = 200
+
+    def get_app(self):
+        self.db = RequestsDB(database=".test.db")
+        self.db.clear()
+        # drop the requests left by the other tests
+        server.REQUESTS_QUEUE.take()
+        self.writer = RequestsWriter(RequestsDB(database=".test.db"))
+        self.writer.start()
+        return getApp(self.db, queue_max_size=2, writer=self.writer)
+
+    def tearDown(self):
+        super().tearDown()
+        self.writer.stop()
+        self.db.clear()
+
+    def test_statistics(self):
+        for limit in [20, 20, 20, 30]:
+            resp = self.fetch(
+                "/fizzbuzz/sequence",
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                body=json_encode({"int1": 3, "int2": 5, "limit": limit, "str1": "fizz", "str2": "buzz"}),
+            )
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+
+        resp = self.fetch("/fizzbuzz/statistics", method="GET")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        stats = json_decode(resp.body).get("stats")
+        self.assertEqual([stat.get("nb_occurences") for stat in stats], [3, 1])
+
+    def test_queue_lag(self):
+        def lags():
+            metrics = self.fetch("/metrics").body.decode().splitlines()
+            return [float(line.split()[1]) for name in [
+                "fizzbuzz_requests_queue_lag_seconds",
+                "fizzbuzz_requests_queue_last_flush_lag_seconds"]
+                for line in metrics if line.startswith(name + " ")]
+
+        self.assertEqual(lags()[0], 0)
+        self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz")
+        (first_lag, _) = lags()
+        self.assertGreater(first_lag, 0)
+        # the queue is flushed to the writer once it holds 2 requests
+        self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz")
+        (lag, last_flush_lag) = lags()
+        self.assertEqual(lag, 0)
+        self.assertGreater(last_flush_lag, first_lag)
+
+    def test_full_writer(self):
+        writer = RequestsWriter(MemoryRequestsDB(), max_pending=1)
+        server.REQUESTS_QUEUE.add("3_5_20_fizz_buzz")
+        server.flush_queue(None, writer)
+        # the requests are kept in the queue rather than waiting for the writer
+        server.REQUESTS_QUEUE.add("2_3_6_a_b")
+        server.flush_queue(None, writer)
+        self.assertEqual(server.REQUESTS_QUEUE.nb_requests, 1)
+
+        writer.start()
+        server.flush_queue(None, writer, wait=True)
+        self.assertFalse(server.REQUESTS_QUEUE)
+        self.assertTrue(writer.stop(timeout=5))
+        self.assertEqual(set(writer.db.get_counts()), set([("2_3_6_a_b", 1), ("3_5_20_fizz_buzz", 1)]))
+
+    @testing.gen_test
+    async def test_sync_top_requests(self):
+        top_requests = TopRequests()
+        top_requests.add("2_3_6_a_b")
+        # requests saved by another server process
+        self.db.add_batch([("3_5_20_fizz_buzz", None, 5)])
+        server.REQUESTS_QUEUE.add("3_5_20_fizz_buzz")
+        await server.sync_top_requests(self.db, self.writer, top_requests)
+        self.assertEqual(top_requests.top(), [("3_5_20_fizz_buzz", 6)])
+
+        # the pending requests are saved first
+        server.REQUESTS_QUEUE.add("2_3_6_a_b")
+        await server.sync_top_requests(self.db, None, top_requests)
+        self.assertEqual(top_requests.top(), [("3_5_20_fizz_buzz", 6), ("2_3_6_a_b", 1)])
+
+class TestFizzBuzzServerMemoryDB(testing.AsyncHTTPTestCase):
+    HTTP_STATUS_OK = 200
+
+    def get_app(self):
+        self.db = get_requests_db("memory", sequence_mode="full")
+        # drop the requests left by the other tests
+        server.REQUESTS_QUEUE.take()
+        # the memory db is shared with the writer
+        self.writer = RequestsWriter(self.db)
+        self.writer.start()
+        self.cache = SequenceCache()
+        return getApp(self.db, queue_max_size=2, writer=self.writer, cache=self.cache)
+
+    def tearDown(self):
+        super().tearDown()
+        self.writer.stop()
+
+    def test_saved_requests(self):
+        for limit in [20, 20]:
+            resp = self.fetch(f"/fizzbuzz/sequence?int1=3&int2=5&limit={limit}&str1=fizz&str2=buzz")
+            self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        self.writer.drain(1)
+        want = FizzBuzzSeqGenerator(3, 5, 20, "fizz", "buzz").sequence()
+        self.assertEqual(self.db.get_most_hit(), [("3_5_20_fizz_buzz", want, 2)])
+
+        # the sequence is loaded from the db once it's evicted
+        self.cache.clear()
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=20&str1=fizz&str2=buzz")
+        self.assertEqual(json_decode(resp.body).get("sequence"), want)
+        metrics = self.fetch("/metrics").body.decode().splitlines()
+        self.assertIn('fizzbuzz_db_lookups_total{result="hit"} 1', metrics)
+
+    def test_loaded_prefix_source(self):
+        url = "/fizzbuzz/sequence?int1=3&int2=5&limit={}&str1=fizz&str2=buzz"
+        self.fetch(url.format(5000))
+        server.flush_queue(self.db, self.writer)
+        self.writer.drain(1)
+        # the sequence generated then indexed is loaded back from the db, and
+        # can't be sliced anymore
+        self.cache.clear()
+        self.fetch(url.format(5000))
+        self.assertIsNone(self.cache.get("3_5_5000_fizz_buzz").offsets)
+
+        resp = self.fetch(url.format(100))
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        want = FizzBuzzSeqGenerator(3, 5, 100, "fizz", "buzz").sequence()
+        self.assertEqual(json_decode(resp.body).get("sequence"), want)
+
+    def test_unknown_backend(self):
+        with self.assertRaisesRegex(ValueError, "unknown db backend"):
+            get_requests_db("invalid")
+
+class TestFizzBuzzServerOverloaded(testing.AsyncHTTPTestCase):
+    HTTP_STATUS_SERVICE_UNAVAILABLE = 503
+
+    def get_app(self):
+        # every generation is rejected
+        return getApp(admission=AdmissionControl(1, 0, 0))
+
+    def test_shed_request(self):
+        # bigger than the sequences generated inline, without admission
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=5000&str1=fizz&str2=buzz")
+        self.assertEqual(resp.code, self.HTTP_STATUS_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers.get("Retry-After"), "1")
+        # the error isn't cached as the sequence
+        for header in ["Cache-Control", "Etag", "Vary"]:
+            self.assertNotIn(header, resp.headers)
+
+class TestFizzBuzzServerProfiler(testing.AsyncHTTPTestCase):
+    HTTP_STATUS_OK = 200
+
+    def get_app(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(self.directory, interval=0.001)
+        return getApp(profiler=self.profiler)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_request_profile(self):
+        resp = self.fetch("/fizzbuzz/sequence?int1=3&int2=5&limit=2000&str1=fizz&str2=buzz",
+                          headers={"X-Fizzbuzz-Profile": "1"})
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        path = resp.headers.get("X-Fizzbuzz-Profile")
+        self.assertTrue(path.startswith(self.directory))
+        self.assertTrue(os.path.exists(path))
+
+    def test_profile_session(self):
+        resp = self.fetch("/admin/profile?mode=sample&seconds=0.05", method="POST", body="")
+        self.assertEqual(resp.code, self.HTTP_STATUS_OK)
+        path = json_decode(resp.body).get("profile").get("path")
+
+        resp = self.fetch("/admin/profile?mode=cprofile", method="POST", body="")
+        self.assertEqual(resp.code, 409)
+        resp = self.fetch("/admin/profile?seconds=0", method="POST", body="")
+        self.assertEqual(resp.code, 400)
+
+        self.io_loop.run_sync(lambda: gen.sleep(0.1))
+        self.assertIsNone(self.profiler.session)
+        self.assertTrue(os.path.exists(path))
+
 if __name__ == "__main__":
     testing.main()